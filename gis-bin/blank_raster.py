@@ -11,22 +11,42 @@
 import sys
 import numpy
 from osgeo import gdal
+from osgeo import gdal_array
 
-def create_blank_raster(extent,cellsize,outfile,format):
+# Tiled, sparse GeoTIFFs only store the blocks that get written
+GTIFF_OPTIONS = ['TILED=YES', 'SPARSE_OK=TRUE', 'BIGTIFF=IF_SAFER']
+
+# Pixels per chunk when writing a fill value
+CHUNK_PIXELS = 4194304
+
+def create_blank_raster(extent,cellsize,outfile,format,fill=None,nodata=None,
+                        band_type=gdal.GDT_Float32,options=None):
     """
-    Creates a blank raster dataset with all zeros
+    Creates a blank raster dataset
+
+    Nothing is written unless fill is given and differs from what an
+    unwritten block reads back as (nodata if set, otherwise zero), so even
+    huge grids are created almost instantly. A fill value is written in
+    chunks of whole blocks, reusing one buffer. For GTiff, options are
+    added to GTIFF_OPTIONS.
     """
     ydist = extent[3] - extent[1]
     xdist = extent[2] - extent[0]
     xcount = int((xdist/cellsize)+1)
     ycount = int((ydist/cellsize)+1)
 
-    # Create the blank numpy array
-    outArray = numpy.zeros( (ycount, xcount) )
+    # A new list each call, so nothing leaks into GTIFF_OPTIONS; options
+    # given by the caller win over the defaults with the same name
+    extra = list(options or [])
+    options = []
+    if format == "GTiff":
+        names = [o.split('=')[0].upper() for o in extra]
+        options = [o for o in GTIFF_OPTIONS if o.split('=')[0] not in names]
+    options = options + extra
 
     # Create output raster  
     driver = gdal.GetDriverByName( format )
-    dst_ds = driver.Create( outfile, xcount, ycount, 1, gdal.GDT_Float32 )
+    dst_ds = driver.Create( outfile, xcount, ycount, 1, band_type, options )
 
     # This is bizzarly complicated
     # the GT(2) and GT(4) coefficients are zero,     
@@ -36,7 +56,25 @@ def create_blank_raster(extent,cellsize,outfile,format):
     dst_ds.SetGeoTransform(gt)
     
     dst_band = dst_ds.GetRasterBand(1)
-    dst_band.WriteArray(outArray,0,0)
+    empty = 0
+    if nodata is not None:
+        dst_band.SetNoDataValue(nodata)
+        empty = nodata
+
+    if fill is not None and fill != empty:
+        blockx, blocky = dst_band.GetBlockSize()
+        xchunk = min(xcount, max(1, CHUNK_PIXELS / (blockx * blocky)) * blockx)
+        ychunk = min(ycount, max(1, CHUNK_PIXELS / (xchunk * blocky)) * blocky)
+
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band_type)
+        chunk = numpy.empty( (ychunk, xchunk), dtype=dtype )
+        chunk.fill(fill)
+        for yoff in range(0, ycount, ychunk):
+            for xoff in range(0, xcount, xchunk):
+                dst_band.WriteArray(chunk[:ycount - yoff, :xcount - xoff], xoff, yoff)
+
+    dst_band = None
+    dst_ds = None
     print
     print "Created blank output %s at %s" % (format, outfile)
 
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+ block_cache.py
+ LRU cache of raster blocks for scripts that make many small, scattered
+ reads against the same rasters.
+
+    from block_cache import BlockCache, CachedBand
+    cache = BlockCache(64 * 1024 * 1024)
+    band = CachedBand(ds, 1, cache)
+    a = band.ReadAsArray(xoff, yoff, 3, 3)
+    print cache.hits, cache.misses
+
+ Reads are turned into whole native blocks, so the same block is only read
+ from disk once while it stays in the cache.
+"""
+import numpy
+import itertools
+from collections import OrderedDict
+
+# Default byte budget for a cache
+CACHE_BYTES = 64 * 1024 * 1024
+
+class BlockCache:
+    """
+    Blocks keyed by (band, block_x, block_y), evicting the least
+    recently used once the cached arrays exceed max_bytes. One cache can be
+    shared by any number of bands and datasets.
+    """
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.blocks = OrderedDict()
+
+    def get(self, key, load):
+        """
+        Return the block for key, calling load() to read it on a miss
+        """
+        if key in self.blocks:
+            self.hits += 1
+            data = self.blocks.pop(key)
+            self.blocks[key] = data
+            return data
+
+        self.misses += 1
+        data = load()
+        self.blocks[key] = data
+        self.nbytes += data.nbytes
+        # Always keep the newest block, even if it alone is over budget
+        while self.nbytes > self.max_bytes and len(self.blocks) > 1:
+            old_key, old = self.blocks.popitem(last=False)
+            self.nbytes -= old.nbytes
+        return data
+
+    def clear(self):
+        self.blocks.clear()
+        self.nbytes = 0
+
+# Numbers the CachedBands so each keeps its own blocks in a shared cache
+_band_ids = itertools.count()
+
+class CachedBand:
+    """
+    Stands in for a GDAL band, serving ReadAsArray from cached native blocks.
+    Anything else is passed through to the wrapped band.
+
+    Blocks are keyed by this object, not the dataset's name: unnamed (MEM)
+    datasets would share a name, and a file rewritten and opened again
+    must not be served blocks read from its old contents.
+    """
+    def __init__(self, ds, bandnum=1, cache=None):
+        if cache is None:
+            cache = BlockCache()
+        self.ds = ds
+        self.bandnum = bandnum
+        self.band = ds.GetRasterBand(bandnum)
+        self.cache = cache
+        self.key = next(_band_ids)
+        self.XSize = self.band.XSize
+        self.YSize = self.band.YSize
+        self.blockx, self.blocky = self.band.GetBlockSize()
+
+    def __getattr__(self, name):
+        return getattr(self.band, name)
+
+    def block(self, bx, by):
+        """ Return native block (bx, by), reading it on a cache miss """
+        def load():
+            xoff = bx * self.blockx
+            yoff = by * self.blocky
+            return self.band.ReadAsArray(xoff, yoff,
+                                         min(self.blockx, self.XSize - xoff),
+                                         min(self.blocky, self.YSize - yoff))
+        return self.cache.get((self.key, bx, by), load)
+
+    def ReadAsArray(self, xoff=0, yoff=0, win_xsize=None, win_ysize=None):
+        if win_xsize is None:
+            win_xsize = self.XSize - xoff
+        if win_ysize is None:
+            win_ysize = self.YSize - yoff
+        if xoff < 0 or yoff < 0 or win_xsize <= 0 or win_ysize <= 0 or \
+           xoff + win_xsize > self.XSize or yoff + win_ysize > self.YSize:
+            raise ValueError("Access window out of range: %d,%d %dx%d" %
+                             (xoff, yoff, win_xsize, win_ysize))
+
+        out = None
+        for by in range(yoff / self.blocky, (yoff + win_ysize - 1) / self.blocky + 1):
+            for bx in range(xoff / self.blockx, (xoff + win_xsize - 1) / self.blockx + 1):
+                data = self.block(bx, by)
+                if out is None:
+                    out = numpy.empty((win_ysize, win_xsize), dtype=data.dtype)
+
+                # Overlap of the block and the window, in raster pixels
+                x0 = max(xoff, bx * self.blockx)
+                x1 = min(xoff + win_xsize, (bx + 1) * self.blockx)
+                y0 = max(yoff, by * self.blocky)
+                y1 = min(yoff + win_ysize, (by + 1) * self.blocky)
+                out[y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff] = \
+                    data[y0 - by * self.blocky:y1 - by * self.blocky,
+                         x0 - bx * self.blockx:x1 - bx * self.blockx]
+        return out
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""
+ catalog_db.py
+ SQLite store for the gdal_catalog.py and ogr_catalog.py results, with an
+ R-tree on dataset extents so spatial lookups don't rescan text files.
+
+    db = CatalogDB('catalog.sqlite')
+    for path in db.rasters_in_bbox(minx, miny, maxx, maxy):
+        ...
+
+ Tables:
+   rasters        one row per raster dataset, with its extent
+   raster_bands   one row per band (type, min, max, overviews)
+   vector_layers  one row per vector layer, with its extent
+ plus raster_extents and layer_extents R-trees keyed by the row ids. If
+ SQLite was built without the R-tree module, extents are searched through
+ ordinary indexes on the main tables instead.
+"""
+import os
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rasters (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    driver TEXT,
+    srs TEXT,
+    xsize INTEGER,
+    ysize INTEGER,
+    bandcount INTEGER,
+    geotransform TEXT,
+    minx REAL, miny REAL, maxx REAL, maxy REAL
+);
+CREATE TABLE IF NOT EXISTS raster_bands (
+    raster_id INTEGER REFERENCES rasters(id),
+    band INTEGER,
+    band_type TEXT,
+    min REAL,
+    max REAL,
+    overviews INTEGER
+);
+CREATE TABLE IF NOT EXISTS vector_layers (
+    id INTEGER PRIMARY KEY,
+    path TEXT,
+    driver TEXT,
+    layer_num INTEGER,
+    layer_name TEXT,
+    feature_count INTEGER,
+    srs TEXT,
+    minx REAL, miny REAL, maxx REAL, maxy REAL,
+    UNIQUE (path, layer_num)
+);
+CREATE INDEX IF NOT EXISTS rasters_driver ON rasters (driver);
+CREATE INDEX IF NOT EXISTS rasters_srs ON rasters (srs);
+CREATE INDEX IF NOT EXISTS raster_bands_raster ON raster_bands (raster_id);
+CREATE INDEX IF NOT EXISTS raster_bands_type ON raster_bands (band_type);
+CREATE INDEX IF NOT EXISTS vector_layers_driver ON vector_layers (driver);
+CREATE INDEX IF NOT EXISTS vector_layers_srs ON vector_layers (srs);
+"""
+
+RTREES = """
+CREATE VIRTUAL TABLE IF NOT EXISTS raster_extents USING rtree (id, minx, maxx, miny, maxy);
+CREATE VIRTUAL TABLE IF NOT EXISTS layer_extents USING rtree (id, minx, maxx, miny, maxy);
+"""
+
+# Used when the R-tree module is missing
+EXTENT_INDEXES = """
+CREATE INDEX IF NOT EXISTS rasters_extent ON rasters (minx, maxx);
+CREATE INDEX IF NOT EXISTS vector_layers_extent ON vector_layers (minx, maxx);
+"""
+
+def under(root, path):
+    """ True if path is root or somewhere below it """
+    root = os.path.normpath(root)
+    path = os.path.normpath(path)
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+def geotransform_extent(gt, xsize, ysize):
+    """ Return (minx, miny, maxx, maxy) of a raster from its geotransform """
+    xs = []
+    ys = []
+    for px, py in ((0, 0), (xsize, 0), (0, ysize), (xsize, ysize)):
+        xs.append(gt[0] + px * gt[1] + py * gt[2])
+        ys.append(gt[3] + px * gt[4] + py * gt[5])
+    return min(xs), min(ys), max(xs), max(ys)
+
+class CatalogDB:
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+        self.conn.executescript(SCHEMA)
+        try:
+            self.conn.executescript(RTREES)
+            self.rtree = True
+        except sqlite3.OperationalError:
+            self.conn.executescript(EXTENT_INDEXES)
+            self.rtree = False
+
+    def add_raster(self, path, driver, srs, xsize, ysize, geotransform, bands):
+        """
+        Store a raster, replacing any earlier entry for the same path.
+        bands is a list of (band_type, min, max, overviews).
+        """
+        self.remove_raster(path)
+        minx, miny, maxx, maxy = geotransform_extent(geotransform, xsize, ysize)
+        cur = self.conn.execute(
+            "INSERT INTO rasters (path, driver, srs, xsize, ysize, bandcount, geotransform,"
+            " minx, miny, maxx, maxy) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+            (path, driver, srs, xsize, ysize, len(bands), str(tuple(geotransform)),
+             minx, miny, maxx, maxy))
+        raster_id = cur.lastrowid
+        self.conn.executemany(
+            "INSERT INTO raster_bands (raster_id, band, band_type, min, max, overviews)"
+            " VALUES (?,?,?,?,?,?)",
+            [(raster_id, i + 1) + tuple(b) for i, b in enumerate(bands)])
+        if self.rtree:
+            self.conn.execute("INSERT INTO raster_extents VALUES (?,?,?,?,?)",
+                              (raster_id, minx, maxx, miny, maxy))
+        return raster_id
+
+    def remove_raster(self, path):
+        for (raster_id,) in self.conn.execute("SELECT id FROM rasters WHERE path = ?", (path,)).fetchall():
+            self.conn.execute("DELETE FROM raster_bands WHERE raster_id = ?", (raster_id,))
+            if self.rtree:
+                self.conn.execute("DELETE FROM raster_extents WHERE id = ?", (raster_id,))
+            self.conn.execute("DELETE FROM rasters WHERE id = ?", (raster_id,))
+
+    def add_layer(self, path, driver, layer_num, layer_name, feature_count, srs, extent):
+        """
+        Store a vector layer, replacing any earlier entry for it.
+        extent is (minx, maxx, miny, maxy), the order OGR's GetExtent() uses.
+        """
+        self.remove_layer(path, layer_num)
+        minx, maxx, miny, maxy = extent
+        cur = self.conn.execute(
+            "INSERT INTO vector_layers (path, driver, layer_num, layer_name, feature_count,"
+            " srs, minx, miny, maxx, maxy) VALUES (?,?,?,?,?,?,?,?,?,?)",
+            (path, driver, layer_num, layer_name, feature_count, srs, minx, miny, maxx, maxy))
+        if self.rtree:
+            self.conn.execute("INSERT INTO layer_extents VALUES (?,?,?,?,?)",
+                              (cur.lastrowid, minx, maxx, miny, maxy))
+        return cur.lastrowid
+
+    def remove_layer(self, path, layer_num):
+        for (layer_id,) in self.conn.execute("SELECT id FROM vector_layers WHERE path = ? AND layer_num = ?",
+                                             (path, layer_num)).fetchall():
+            if self.rtree:
+                self.conn.execute("DELETE FROM layer_extents WHERE id = ?", (layer_id,))
+            self.conn.execute("DELETE FROM vector_layers WHERE id = ?", (layer_id,))
+
+    def remove_missing_rasters(self, root, seen):
+        """
+        Delete the rasters under root whose paths aren't in seen, the set
+        of paths a scan of root just stored. Returns how many went.
+        """
+        gone = [path for (path,) in self.conn.execute("SELECT path FROM rasters").fetchall()
+                if under(root, path) and path not in seen]
+        for path in gone:
+            self.remove_raster(path)
+        return len(gone)
+
+    def remove_missing_layers(self, root, seen):
+        """
+        Delete the layers under root whose (path, layer_num) aren't in
+        seen, the set a scan of root just stored. Returns how many went.
+        """
+        gone = [(path, num) for path, num in
+                self.conn.execute("SELECT path, layer_num FROM vector_layers").fetchall()
+                if under(root, path) and (path, num) not in seen]
+        for path, num in gone:
+            self.remove_layer(path, num)
+        return len(gone)
+
+    def _in_bbox(self, table, rtree, columns, minx, miny, maxx, maxy, where):
+        if self.rtree:
+            sql = ("SELECT %s FROM %s t JOIN %s r ON t.id = r.id"
+                   " WHERE r.minx <= ? AND r.maxx >= ? AND r.miny <= ? AND r.maxy >= ?"
+                   % (columns, table, rtree))
+        else:
+            sql = ("SELECT %s FROM %s t"
+                   " WHERE t.minx <= ? AND t.maxx >= ? AND t.miny <= ? AND t.maxy >= ?"
+                   % (columns, table))
+        for condition, value in where:
+            sql += " AND " + condition
+        sql += " ORDER BY t.id"
+        args = (maxx, minx, maxy, miny) + tuple([v for c, v in where])
+        return self.conn.execute(sql, args).fetchall()
+
+    def _filters(self, driver, srs):
+        return [("t.%s = ?" % c, v) for c, v in (('driver', driver), ('srs', srs)) if v is not None]
+
+    def rasters_in_bbox(self, minx, miny, maxx, maxy, driver=None, srs=None, band_type=None):
+        """ Return the paths of rasters whose extent touches the box """
+        where = self._filters(driver, srs)
+        if band_type is not None:
+            where.append(("EXISTS (SELECT 1 FROM raster_bands b"
+                          " WHERE b.raster_id = t.id AND b.band_type = ?)", band_type))
+        rows = self._in_bbox('rasters', 'raster_extents', 't.path',
+                             minx, miny, maxx, maxy, where)
+        return [r[0] for r in rows]
+
+    def layers_in_bbox(self, minx, miny, maxx, maxy, driver=None, srs=None):
+        """ Return (path, layer_name) of vector layers whose extent touches the box """
+        return self._in_bbox('vector_layers', 'layer_extents', 't.path, t.layer_name',
+                             minx, miny, maxx, maxy, self._filters(driver, srs))
+
+    def raster_extents(self):
+        """ Return (path, minx, miny, maxx, maxy) for every raster """
+        return self.conn.execute("SELECT path, minx, miny, maxx, maxy FROM rasters ORDER BY id").fetchall()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+if __name__ == '__main__':
+    # Self-check: rescanning a folder drops what has gone from it, and
+    # leaves other folders alone
+    db = CatalogDB(':memory:')
+    gt = (0, 1, 0, 10, 0, -1)
+    for path in ('/data/a.tif', '/data/b.tif', '/data/sub/c.tif', '/database/d.tif'):
+        db.add_raster(path, 'GTiff', '', 10, 10, gt, [('Byte', 0, 255, 0)])
+    db.add_layer('/data/roads.shp', 'ESRI Shapefile', 0, 'roads', 5, '', (0, 1, 0, 1))
+    db.add_layer('/data/multi.gml', 'GML', 0, 'a', 5, '', (0, 1, 0, 1))
+    db.add_layer('/data/multi.gml', 'GML', 1, 'b', 5, '', (0, 1, 0, 1))
+
+    assert db.remove_missing_rasters('/data/', set(['/data/a.tif'])) == 2
+    assert [r[0] for r in db.raster_extents()] == ['/data/a.tif', '/database/d.tif']
+    assert db.rasters_in_bbox(0, 0, 10, 10) == ['/data/a.tif', '/database/d.tif']
+    assert db.conn.execute("SELECT count(*) FROM raster_bands").fetchone()[0] == 2
+
+    assert db.remove_missing_layers('/data', set([('/data/multi.gml', 1)])) == 2
+    assert db.layers_in_bbox(0, 0, 1, 1) == [('/data/multi.gml', 'b')]
+    print 'ok'
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+ catalog_manifest.py
+ Remembers what the catalog scripts found in each file, keyed by path,
+ modification time and size, so a re-run only opens files that changed.
+
+    manifest = Manifest('raster_manifest.json')
+    record = manifest.get(path)
+    if record is MISSING:
+        record = scan(path)
+        manifest.put(path, record)
+    manifest.save()
+
+ Files that turned out not to be datasources are remembered too (as a
+ record of None), since trying to open them is most of the cost, so test
+ for MISSING rather than None.
+"""
+import os
+import json
+
+# get() returns this when a path has no usable entry
+MISSING = object()
+
+# Paths and records are byte strings. Latin-1 maps each byte to one code
+# point, so any path, in any filesystem encoding, survives the JSON round trip
+ENCODING = 'latin-1'
+
+def _to_bytes(obj, encoding):
+    """ Turn the unicode json.load gives back into the byte strings stored """
+    if isinstance(obj, unicode):
+        return obj.encode(encoding)
+    if isinstance(obj, list):
+        return [_to_bytes(o, encoding) for o in obj]
+    if isinstance(obj, dict):
+        return dict((_to_bytes(k, encoding), _to_bytes(v, encoding)) for k, v in obj.items())
+    return obj
+
+def file_key(path):
+    """
+    Return [mtime, size] for path, or None if it can't be stat'ed
+
+    A directory (an ArcInfo grid, say) doesn't change when the files in it
+    are rewritten, so its key is the newest mtime among it and the
+    entries directly inside, their total size and how many there are.
+    """
+    try:
+        st = os.stat(path)
+        if not os.path.isdir(path):
+            return [st.st_mtime, st.st_size]
+        mtime, size = st.st_mtime, 0
+        names = os.listdir(path)
+        for name in names:
+            try:
+                entry = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            mtime = max(mtime, entry.st_mtime)
+            size += entry.st_size
+    except OSError:
+        return None
+    return [mtime, size, len(names)]
+
+class Manifest:
+    """
+    version identifies the layout of the records; a manifest written with
+    a different version is ignored and everything is scanned again
+    """
+    def __init__(self, filename=None, version=1):
+        self.filename = filename
+        self.version = version
+        self.entries = {}
+        self.seen = set()
+        if filename and os.path.exists(filename):
+            try:
+                stored = json.load(open(filename))
+            except ValueError:
+                print "** ignoring unreadable manifest", filename
+                stored = {}
+            if stored.get('version') == version:
+                # manifests from before ENCODING was recorded used json's utf-8
+                self.entries = _to_bytes(stored['entries'], stored.get('encoding', 'utf-8'))
+
+    def get(self, path, key=None):
+        """
+        Return the stored record for path, or MISSING if there is none or
+        the file changed since it was stored
+        """
+        if key is None:
+            key = file_key(path)
+        self.seen.add(path)
+        entry = self.entries.get(path)
+        if entry is None or key is None or entry[0] != key:
+            return MISSING
+        return entry[1]
+
+    def put(self, path, record, key=None):
+        if key is None:
+            key = file_key(path)
+        self.seen.add(path)
+        if key is not None:
+            self.entries[path] = [key, record]
+
+    def save(self):
+        """
+        Write the entries for paths seen this run, dropping files that
+        have since gone away
+        """
+        if not self.filename:
+            return
+        entries = dict((p, e) for p, e in self.entries.items() if p in self.seen)
+        tmp = self.filename + '.tmp'
+        fh = open(tmp, 'w')
+        json.dump({'version': self.version, 'encoding': ENCODING, 'entries': entries},
+                  fh, encoding=ENCODING)
+        fh.close()
+        os.rename(tmp, self.filename)
@@ -4,6 +4,7 @@ import time
 import os
 from osgeo import gdal
 from numpy.lib import stride_tricks
+from focal import focal_array
 DRAW = True
 SAVE = False
 try:
@@ -29,11 +30,70 @@ def get_GDT_from_dtype(dtype):
         return mapping[str(dtype)]
     except KeyError:
         return gdal.GDT_Float32
+
+# Rules take the (rows, cols, 3, 3) view of every neighborhood window
+# at once and return a (rows, cols) array with the new value of each cell
+
+def rule_min(win):
+    return win.min(axis=(2, 3))
+
+def rule_max(win):
+    return win.max(axis=(2, 3))
+
+def rule_sum(win):
+    return win.sum(axis=(2, 3))
+
+def rule_majority(win):
+    """
+    Most common value in each window, ties go to the smallest value
+    """
+    flat = np.sort(win.reshape(win.shape[:2] + (-1,)), axis=2)
+    best = flat[:, :, 0].copy()
+    best_run = np.ones(best.shape, dtype=np.int32)
+    run = np.ones(best.shape, dtype=np.int32)
+    for k in range(1, flat.shape[2]):
+        run = np.where(flat[:, :, k] == flat[:, :, k - 1], run + 1, 1)
+        longer = run > best_run
+        best[longer] = flat[:, :, k][longer]
+        best_run[longer] = run[longer]
+    return best
+
+def focal_rule(stat, size=3, shape='rect'):
+    """
+    Build a rule from one of the focal.py statistics, with any window size;
+    windows reaching past the edge of the state only count the cells inside
+    """
+    def rule(win):
+        # Copy the state back out of the windows: the top-left cell of each
+        # window, plus the last window's row and column for the edges
+        rows, cols = win.shape[:2]
+        state = np.empty((rows + 2, cols + 2), dtype=win.dtype)
+        state[:rows, :cols] = win[:, :, 0, 0]
+        state[:rows, cols:] = win[:, -1, 0, 1:]
+        state[rows:, :cols] = win[-1, :, 1:, 0].T
+        state[rows:, cols:] = win[-1, -1, 1:, 1:]
+        out = focal_array(state, stat, shape, size)[1:-1, 1:-1]
+        return out.astype(win.dtype)
+    return rule
+
+def cellwise(rule):
+    """
+    Wrap a rule written for a single 3x3 window so it can be used with run()
+    Calls rule once per cell, so it is as slow as that sounds
+    """
+    def vectorized(win):
+        out = np.empty(win.shape[:2], dtype=win.dtype)
+        for i in range(win.shape[0]):
+            for j in range(win.shape[1]):
+                out[i, j] = rule(win[i, j])
+        return out
+    return vectorized
     
 
 class CellularAutomata:
     def __init__(self, orig, rule, geotrans):
-        self.state_in = orig
+        # run() swaps between the two buffers, so keep orig out of them
+        self.state_in = orig.copy()
         self.state_out = orig.copy()
         self.scale_img = float(np.max(orig))
         self.rule = rule
@@ -100,11 +160,12 @@ class CellularAutomata:
                     shape=(window_shape[0], window_shape[1], hood[0], hood[1]), 
                     strides=x.strides + x.strides)
 
-            for i in range(window_shape[0]):
-                for j in range(window_shape[1]):
-                    y[i+1,j+1] = self.rule(xx[i,j])
+            y[1:-1, 1:-1] = self.rule(xx)
 
-            x = y.copy()
+            # Swap buffers instead of copying; the border cells are never
+            # written so both keep the original ones
+            x, y = y, x
+        self.state_in, self.state_out = x, y
         self.output(x)
         if self.draw:
             print "Done.. "
@@ -119,17 +180,13 @@ class CellularAutomata:
 
 if __name__ == "__main__":
 
-    import random
     def simple_rule(win):
         """
-        Rule must return a single scalar value for each neighborhood window
+        Rule must return a single value for each neighborhood window
         Randomly takes min or max
         """
-        c = random.choice(['min','max'])
-        if c == 'max':
-            return np.max(win)
-        else:
-            return np.min(win)
+        take_max = np.random.randint(0, 2, win.shape[:2]).astype(bool)
+        return np.where(take_max, rule_max(win), rule_min(win))
 
     size = 128
     #start = np.array(np.random.randint(0,255,size*size).reshape([size,size]), dtype=np.int32)
@@ -59,6 +59,14 @@ For example:
 
     python classify_terrain.py dem.tif aspect.tif slope.tif config.csv terrain_zones.tif
 
+- Alternatively, pass only the DEM and slope and aspect are derived block by block in memory,
+using the same 3x3 window as hillshade.py:
+
+    python classify_terrain.py <dem> <configuration> <ouput tif>
+
+The DEM must use the same units horizontally and vertically. Flat pixels get an aspect of -9999,
+as with gdaldem, so they never fall into a zone.
+
 The output terrain_zones.tif file will have pixel values of 0 when the pixel does not match ANY 
 of the zone criteria. If it matches, the output pixel value will be the appropriate category number. 
 """
@@ -66,9 +74,11 @@ import sys
 import numpy
 from osgeo import gdal
 from progressbar import ProgressBar, Percentage, ETA, SimpleProgress
+from hillshade import gradient
 
 USAGE = """
     python create_terrain.py <dem> <aspect> <slope> <configuration> <ouput tif>
+    python create_terrain.py <dem> <configuration> <ouput tif>
 
     An example configuration would be as follows; 
     We want to create a "Yellow" zone above 1400 meters, 
@@ -78,6 +88,7 @@ USAGE = """
 """
 
 NO_ZONE = 0
+FLAT_ASPECT = -9999
 
 class Zone:
     def __repr__(self):
@@ -110,6 +121,63 @@ def classify_zone(elev, aspect, slope, cfg):
 
     return NO_ZONE
 
+def classify_block(elev, aspect, slope, cfg):
+    """
+    Classify whole arrays of elevation, aspect and slope at once.
+
+    Builds a boolean mask per Zone with the same tests as classify_zone
+    and lets numpy.select pick the first matching zone for each pixel.
+    """
+    conditions = []
+    for zone in cfg:
+        match = (slope >= zone.minslope) & (elev >= zone.minelev)
+        if zone.maxaspect < zone.minaspect:
+            # includes N
+            match &= ((aspect >= zone.minaspect) & (aspect <= 360.)) | \
+                     ((aspect <= zone.maxaspect) & (aspect >= 0.0))
+        else:
+            # doesn't include N
+            match &= (aspect >= zone.minaspect) & (aspect <= zone.maxaspect)
+        conditions.append(match)
+
+    zones = numpy.select(conditions, [zone.id for zone in cfg], NO_ZONE)
+    return zones.astype(numpy.int16)
+
+def read_with_halo(band, xoff, yoff, cols, rows):
+    """
+    Read a block plus a one pixel halo, repeating the edge pixels where
+    the halo falls off the raster.
+    """
+    x0 = max(xoff - 1, 0)
+    y0 = max(yoff - 1, 0)
+    x1 = min(xoff + cols + 1, band.XSize)
+    y1 = min(yoff + rows + 1, band.YSize)
+    data = band.ReadAsArray(x0, y0, x1 - x0, y1 - y0).astype(numpy.float64)
+    pad = ((y0 - (yoff - 1), (yoff + rows + 1) - y1),
+           (x0 - (xoff - 1), (xoff + cols + 1) - x1))
+    return numpy.pad(data, pad, 'edge')
+
+def slope_aspect(cell, xres, yres, nodata=None):
+    """
+    Derive slope (degrees) and aspect (degrees clockwise from North) for 
+    the interior of cell using the hillshade() window.
+
+    Returns (slope, aspect, valid) where valid is False for pixels whose
+    window touches nodata.
+    """
+    x, y, window = gradient(cell, xres, yres)
+
+    slope = numpy.degrees(numpy.arctan(numpy.sqrt(x*x + y*y)))
+    # x points downhill to the East and y uphill to the North
+    aspect = numpy.degrees(numpy.arctan2(x, -y)) % 360.0
+    aspect[(x == 0) & (y == 0)] = FLAT_ASPECT
+
+    valid = numpy.ones(slope.shape, dtype=bool)
+    if nodata is not None:
+        for pane in window:
+            valid &= pane != nodata
+    return slope, aspect, valid
+
 
 def parse_config(fh):
     lines = fh.readlines()
@@ -136,28 +204,33 @@ if __name__ == '__main__':
 
     gdal.AllRegister()
     argv = gdal.GeneralCmdLineProcessor( sys.argv )
-    if len(argv) < 6:
+    if len(argv) == 4:
+        demfile, cfgfile, outfile = argv[1:4]
+    elif len(argv) >= 6:
+        demfile, aspectfile, slopefile, cfgfile, outfile = argv[1:6]
+    else:
         print USAGE
         sys.exit( 0 )
 
-    dem = gdal.Open( argv[1], gdal.GA_ReadOnly )
-    aspect = gdal.Open( argv[2], gdal.GA_ReadOnly )
-    slope = gdal.Open( argv[3], gdal.GA_ReadOnly )
+    dem = gdal.Open( demfile, gdal.GA_ReadOnly )
     if dem is None: 
-        print "DEM %s is not a valid raster file" % argv[1]
-        sys.exit( 0 )
-    if aspect is None: 
-        print "Aspect '%s' is not a valid raster file" % argv[2]
-        sys.exit( 0 )
-    if slope is None: 
-        print "Slope '%s' is not a valid raster file" % argv[3]
+        print "DEM %s is not a valid raster file" % demfile
         sys.exit( 0 )
+    if len(argv) >= 6:
+        aspect = gdal.Open( aspectfile, gdal.GA_ReadOnly )
+        slope = gdal.Open( slopefile, gdal.GA_ReadOnly )
+        if aspect is None: 
+            print "Aspect '%s' is not a valid raster file" % aspectfile
+            sys.exit( 0 )
+        if slope is None: 
+            print "Slope '%s' is not a valid raster file" % slopefile
+            sys.exit( 0 )
 
     try:
-        cfg_fh = open(argv[4], 'r')
+        cfg_fh = open(cfgfile, 'r')
         cfg = parse_config(cfg_fh) 
     except:
-        print "Configuration file '%s' is not valid" % argv[4]
+        print "Configuration file '%s' is not valid" % cfgfile
         sys.exit( 0 )
 
     for z in cfg:
@@ -172,6 +245,8 @@ if __name__ == '__main__':
     
     # Confirm the same extents and sizes
     for fh in [slope, aspect]:
+        if fh is None:
+            continue
         try:
             assert geotransform == fh.GetGeoTransform()
             assert xsize == fh.RasterXSize
@@ -188,7 +263,7 @@ if __name__ == '__main__':
 
     bands = 1
     band_type = gdal.GDT_Int16
-    out = driver.Create( argv[5], xsize, ysize, bands, band_type )
+    out = driver.Create( outfile, xsize, ysize, bands, band_type )
     if out is None:
         print 'Creation failed, terminating.'
         sys.exit( 1 )
@@ -197,35 +272,43 @@ if __name__ == '__main__':
     if projection:
         out.SetProjection(projection)
 
-    # Go line-by-line through 3 inputs, match to Zones and output line
+    # Go block-by-block through 3 inputs, match to Zones and output block
     demband = dem.GetRasterBand(1)
-    aspectband = aspect.GetRasterBand(1)
-    slopeband = slope.GetRasterBand(1)
     outband = out.GetRasterBand(1) 
-  
-    demdata = demband.ReadAsArray()
-    aspectdata = aspectband.ReadAsArray()
-    slopedata = slopeband.ReadAsArray()
+    if slope is not None:
+        aspectband = aspect.GetRasterBand(1)
+        slopeband = slope.GetRasterBand(1)
+    else:
+        demnodata = demband.GetNoDataValue()
+        xres, yres = geotransform[1], geotransform[5]
+
+    xblock, yblock = demband.GetBlockSize()
 
     progress = ProgressBar(widgets=['Processed Lines ', SimpleProgress(), ' (', Percentage(), ') ' , ETA(), ' remaining' ],maxval=ysize)
     progress.start()
     progress.update_interval = 1
     progress.next_update = 1
 
-    for line in range(ysize):
-        zones_line = []
-        for xpos in range(xsize):
-            elev = demdata[line,xpos]
-            aspect = aspectdata[line,xpos]
-            slope = slopedata[line,xpos]
-            zone = classify_zone(elev, aspect, slope, cfg)
-            zones_line.append(zone)
-        outband.WriteArray( numpy.array([zones_line]), 0, line )   
-        progress.update(line)
+    for yoff in range(0, ysize, yblock):
+        rows = min(yblock, ysize - yoff)
+        for xoff in range(0, xsize, xblock):
+            cols = min(xblock, xsize - xoff)
+            if slope is not None:
+                demdata = demband.ReadAsArray(xoff, yoff, cols, rows)
+                aspectdata = aspectband.ReadAsArray(xoff, yoff, cols, rows)
+                slopedata = slopeband.ReadAsArray(xoff, yoff, cols, rows)
+                zones = classify_block(demdata, aspectdata, slopedata, cfg)
+            else:
+                demdata = read_with_halo(demband, xoff, yoff, cols, rows)
+                slopedata, aspectdata, valid = slope_aspect(demdata, xres, yres, demnodata)
+                zones = classify_block(demdata[1:-1, 1:-1], aspectdata, slopedata, cfg)
+                zones[~valid] = NO_ZONE
+            outband.WriteArray(zones, xoff, yoff)
+        progress.update(yoff + rows - 1)
 
     dem = None
     aspect = None
     slope = None
     out = None
     print 
-    print " Terrain classification model complete at %s" % argv[5]
+    print " Terrain classification model complete at %s" % outfile
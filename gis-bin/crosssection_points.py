@@ -1,4 +1,5 @@
 import math
+from rasterQuery import RasterSampler
 
 def getPointsFromShp(shp, labelfield):
     from osgeo import ogr
@@ -54,18 +55,22 @@ def calcAngle(A, C, B):
     return alpha
 
     
+def getSampler(raster):
+    # Reuse a RasterSampler given by the caller, rather than opening the raster again
+    if isinstance(raster, RasterSampler):
+        return raster
+    return RasterSampler(raster)
+
 def calcPointTransects(points, transects, thresholdDistance, raster_file=None):
     results = {}
     if raster_file is not None:
-        from osgeo import gdal
-        ds = gdal.Open(raster_file)
-        gt = ds.GetGeoTransform()
-        cellsize = (gt[1]-gt[5])/2
-        band = ds.GetRasterBand(1)
+        sampler = getSampler(raster_file)
+        keys = points.keys()
+        values = sampler.sample([points[p][0] for p in keys], [points[p][1] for p in keys])
+        pointvalues = dict(zip(keys, rasterValueList(values, [points[p] for p in keys])))
         
     for t in transects.keys():
         trans = {}
-        if raster_file is not None: rastvalues = {}
         distOffset = 0.0
         for s in range(1,len(transects[t])):
             for p in points.keys():
@@ -79,8 +84,6 @@ def calcPointTransects(points, transects, thresholdDistance, raster_file=None):
                     if distAlongSegment >= 0 and distAlongSegment <= lengthTransectSeg:
                         distAlongLine = distOffset + distAlongSegment
                         trans[p] = distAlongLine
-                        if raster_file is not None:
-                            rastvalues[p] = getRasterValue(points[p][0],points[p][1],band,gt)
 
         # Sort the transect points
         # and break into two lists (can be zipped back together if needed)               
@@ -94,7 +97,7 @@ def calcPointTransects(points, transects, thresholdDistance, raster_file=None):
             transectDists.append(h[0])
             transectPoints.append(h[1])
             if raster_file is not None:
-                transectRastValues.append( rastvalues[h[1]] )
+                transectRastValues.append( pointvalues[h[1]] )
             
         if raster_file is not None:
             results[t] = (transectDists, transectRastValues, transectPoints)
@@ -122,24 +125,23 @@ def getXYfromM( pts, M):
         newpt = (seg[0][0] - opp, seg[0][1] - adj)
     return newpt
 
-def getRasterValue(x,y,band,gt):
-    xoff = int((x - gt[0]) / gt[1])  
-    yoff = int((y - gt[3]) / gt[5]) 
-    try:
-        a = band.ReadAsArray( xoff, yoff, 1, 1)
-        return a[0][0]        
-    except:
-        print "Coordinates (%s, %s) out of range" % (x,y)
-        return None
+def rasterValueList(values, coords):
+    # Sampler misses (NaN) become None
+    results = []
+    for v, c in zip(values, coords):
+        if v != v:
+            print "Coordinates (%s, %s) out of range" % (c[0],c[1])
+            results.append(None)
+        else:
+            results.append(v)
+    return results
 
     
 def calcRasterTransects(transects, raster_file, output_points=None):
-    from osgeo import gdal
     from numpy import arange
-    ds = gdal.Open(raster_file)
-    gt = ds.GetGeoTransform()
+    sampler = getSampler(raster_file)
+    gt = sampler.ds.GetGeoTransform()
     cellsize = (gt[1]-gt[5])/2
-    band = ds.GetRasterBand(1)
     if output_points:
         ofh = open(output_points,'w')
         ofh.write("x,y,id,transect\n")
@@ -147,7 +149,7 @@ def calcRasterTransects(transects, raster_file, output_points=None):
     for t in transects.keys():
         xsecPoints = []
         xsecDists = []
-        xsecRastValues = []
+        xsecCoords = []
         numpoints = len(transects[t])
         maxlen = transects[t][numpoints-1][2]
         for i in arange(0,maxlen,cellsize*2):
@@ -157,9 +159,10 @@ def calcRasterTransects(transects, raster_file, output_points=None):
                 ofh.write("," + str(i))
                 ofh.write(","+t)
                 ofh.write("\n")
-            rastval = getRasterValue(coords[0],coords[1],band,gt)
             xsecDists.append(i)
-            xsecRastValues.append(rastval)
+            xsecCoords.append(coords)
+        values = sampler.sample([c[0] for c in xsecCoords], [c[1] for c in xsecCoords])
+        xsecRastValues = rasterValueList(values, xsecCoords)
         xsecs[t] = (xsecDists, xsecRastValues)
     if output_points: ofh.close()
     return xsecs
@@ -213,8 +216,10 @@ if __name__ == "__main__":
     points = getPointsFromShp(points_shp, "LOCATION")
     transects = getTransectsFromShp(transects_shp, "transect")
 
-    point_results = calcPointTransects(points, transects, thresholdDistance, raster_file)    
-    raster_results = calcRasterTransects(transects, raster_file, output_points="C:\\temp\\cross\\transect_points.csv")
+    # One sampler, so the DEM is opened and its blocks read once for both
+    dem = RasterSampler(raster_file)
+    point_results = calcPointTransects(points, transects, thresholdDistance, dem)    
+    raster_results = calcRasterTransects(transects, dem, output_points="C:\\temp\\cross\\transect_points.csv")
 
     zipToCSVs(point_results, ["dist","elev","pointid"], "C:\\temp\\cross\\points_")
     zipToCSVs(raster_results, ["dist","elev"], "C:\\temp\\cross\\profile_")
@@ -18,6 +18,7 @@ limitations under the License.
 from osgeo import ogr
 from osgeo import gdal
 import math
+from rasterQuery import RasterSampler
 
 def calc_perp_angles(a):
     left = a - 90
@@ -81,14 +82,11 @@ def parse_input(infile):
 
 def calc_transects(infile, demfile, outdir):
     surveys = parse_input(infile)
-    demds = gdal.Open(demfile)
-    dem = demds.GetRasterBand(1) 
-    gt = demds.GetGeoTransform()
+    dem = RasterSampler(gdal.Open(demfile), fill=0)
 
     for s in surveys:
-        pts = []
-        for p in s.xsecpts:
-            pts.append( (p[2], getRasterValue(p[0],p[1],dem,gt)) )
+        elevs = dem.sample([p[0] for p in s.xsecpts], [p[1] for p in s.xsecpts])
+        pts = zip([p[2] for p in s.xsecpts], elevs)
 
         fh = open(outdir+"X"+s.id+".DAT", 'w')
         fh.write("""*** Stability Analysis
@@ -126,17 +124,6 @@ END
 
        
 
-def getRasterValue(x,y,band,gt):
-    xoff = int((x - gt[0]) / gt[1])  
-    yoff = int((y - gt[3]) / gt[5]) 
-    try:
-        a = band.ReadAsArray( xoff, yoff, 1, 1)
-        return a[0][0]        
-    except:
-        return 0
-
-    
-
 if __name__ == "__main__":
     infile = "/home/perry/Desktop/xsec/pts.csv"
     demfile = "/home/perry/Desktop/xsec/dem.img"
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+ extent_index.py
+ Static R-tree over raster extents, bulk loaded with Sort-Tile-Recursive
+ packing so a mosaic of thousands of files can be queried per output block.
+
+    from extent_index import ExtentIndex
+    index = ExtentIndex(file_infos)
+    for fi in index.query(minx, miny, maxx, maxy):
+        ...
+
+ Items are anything with ulx, uly, lrx, lry attributes, like the file_info
+ objects in gdal_add.py.
+"""
+import math
+
+# Children per node
+NODE_SIZE = 16
+
+def item_bbox(item):
+    """
+    Return (minx, miny, maxx, maxy) for an item with ulx/uly/lrx/lry,
+    whichever way its y axis runs.
+    """
+    return (min(item.ulx, item.lrx), min(item.uly, item.lry),
+            max(item.ulx, item.lrx), max(item.uly, item.lry))
+
+def _union(entries):
+    return (min([e[0][0] for e in entries]), min([e[0][1] for e in entries]),
+            max([e[0][2] for e in entries]), max([e[0][3] for e in entries]))
+
+def _pack(entries, node_size):
+    """
+    Group one level of (bbox, child) entries into parent entries, tiling
+    them into vertical slices by x and then runs of node_size by y.
+    """
+    leaves = int(math.ceil(len(entries) / float(node_size)))
+    slices = int(math.ceil(math.sqrt(leaves)))
+    per_slice = slices * node_size
+
+    def center_x(e):
+        return e[0][0] + e[0][2]
+
+    def center_y(e):
+        return e[0][1] + e[0][3]
+
+    entries = sorted(entries, key=center_x)
+    parents = []
+    for i in range(0, len(entries), per_slice):
+        strip = sorted(entries[i:i + per_slice], key=center_y)
+        for j in range(0, len(strip), node_size):
+            children = strip[j:j + node_size]
+            parents.append((_union(children), children))
+    return parents
+
+class ExtentIndex:
+    """
+    Packed R-tree answering "which items overlap this box" queries.
+    """
+    def __init__(self, items, node_size=NODE_SIZE):
+        self.items = list(items)
+        self.root = None
+
+        # Leaf entries point at item positions, inner entries at child lists
+        level = [(item_bbox(item), i) for i, item in enumerate(self.items)]
+        while len(level) > node_size:
+            level = _pack(level, node_size)
+        if level:
+            self.root = (_union(level), level)
+
+    def query_ids(self, minx, miny, maxx, maxy):
+        """
+        Return the sorted positions of items whose extent overlaps the box.
+        Extents that only touch the box along an edge do not count.
+        """
+        found = []
+        if self.root is None:
+            return found
+
+        stack = [self.root]
+        while stack:
+            bbox, children = stack.pop()
+            for child in children:
+                cminx, cminy, cmaxx, cmaxy = child[0]
+                if cminx < maxx and cmaxx > minx and cminy < maxy and cmaxy > miny:
+                    if isinstance(child[1], list):
+                        stack.append(child)
+                    else:
+                        found.append(child[1])
+        found.sort()
+        return found
+
+    def query(self, minx, miny, maxx, maxy):
+        """
+        Return the items overlapping the box, in the order they were given.
+        """
+        return [self.items[i] for i in self.query_ids(minx, miny, maxx, maxy)]
@@ -33,12 +33,13 @@ import sys
 
 verbose = 0
 
+# Pixels read and written per call when flipping
+CHUNK_PIXELS = 4 * 1024 * 1024
+
 # =============================================================================
 def raster_flip( s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
                  t_fh, t_xoff, t_yoff, t_xsize, t_ysize, t_band_n, nodata ):
 
-    import Numeric
-    
     if verbose != 0:
         print 'Copy %d,%d,%d,%d to %d,%d,%d,%d.' \
               % (s_xoff, s_yoff, s_xsize, s_ysize, t_xoff, \
@@ -47,13 +48,59 @@ def raster_flip( s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
     s_band = s_fh.GetRasterBand( s_band_n )
     t_band = t_fh.GetRasterBand( t_band_n )
 
-    # write out the first line from source file as the last line in the dest
-    for line in range(s_ysize):
-        data_src = s_band.ReadAsArray( s_xoff, line, s_xsize, 1, t_xsize, 1 )
-        t_band.WriteArray( data_src, t_xoff, abs(line - t_ysize) -1  )                             
+    # read whole blocks of lines, at least one block high
+    block_ysize = s_band.GetBlockSize()[1]
+    lines = max( block_ysize, CHUNK_PIXELS / max(t_xsize, 1) / block_ysize * block_ysize )
+
+    # write out the first lines from source file as the last lines in the
+    # dest, reversed through a view rather than a copy
+    for line in range(0, s_ysize, lines):
+        count = min( lines, s_ysize - line )
+        data_src = s_band.ReadAsArray( s_xoff, s_yoff + line, s_xsize, count,
+                                       t_xsize, count )
+        t_band.WriteArray( data_src[::-1], t_xoff, t_yoff + t_ysize - line - count )
     
     return 0
 
+# =============================================================================
+def flip_geotransform( geotransform, ysize ):
+    """
+    Return the geotransform that georeferences the same lines in reverse.
+
+    Keeping the pixels and swapping the geotransform puts every line where
+    raster_flip() would have, so the result is the same flipped raster.
+    """
+    gt = list( geotransform )
+    gt[0] = geotransform[0] + ysize * geotransform[2]
+    gt[2] = -geotransform[2]
+    gt[3] = geotransform[3] + ysize * geotransform[5]
+    gt[5] = -geotransform[5]
+    return gt
+
+# =============================================================================
+def flip_in_place( filename ):
+    """
+    Flip a raster by rewriting only its geotransform, no pixels are touched.
+
+    This changes the input file, and a north-up input comes out south-up
+    (a positive y pixel size), which some tools don't handle.
+
+    Returns 1 on success, or 0 if the format can't be opened for update or
+    won't store a new geotransform.
+    """
+    gdal.PushErrorHandler( 'CPLQuietErrorHandler' )
+    fh = gdal.Open( filename, gdal.GA_Update )
+    gdal.PopErrorHandler()
+    if fh is None:
+        return 0
+
+    gt = flip_geotransform( fh.GetGeoTransform(), fh.RasterYSize )
+    if fh.SetGeoTransform( gt ) != 0:
+        return 0
+
+    fh = None
+    return 1
+
 
 # *****************************************************************************
 class file_info:
@@ -177,9 +224,14 @@ class file_info:
 def Usage():
     print 'Usage: flip_raster.py [-o out_filename] [-of out_format] [-co NAME=VALUE]*'
     print '                      [-v] [-pct] [-n nodata_value] [-init value]'
-    print '                      [-ot datatype] [-createonly] input_files'
+    print '                      [-ot datatype] [-createonly] [-inplace -yes] input_files'
     print '                      [--help-general]'
     print
+    print '  -inplace  Flip by rewriting the geotransform of the input file itself.'
+    print '            THE INPUT FILE IS MODIFIED, and a north-up raster becomes'
+    print '            south-up (positive y pixel size), which some tools mishandle.'
+    print '            Needs -yes to confirm; without -inplace a new file is written.'
+    print
 
 # =============================================================================
 #
@@ -201,6 +253,8 @@ if __name__ == '__main__':
     pre_init = None
     band_type = None
     createonly = 0
+    inplace = 0
+    confirmed = 0
 
     gdal.AllRegister()
     argv = gdal.GeneralCmdLineProcessor( sys.argv )
@@ -222,6 +276,12 @@ if __name__ == '__main__':
         elif arg == '-createonly':
             createonly = 1
 
+        elif arg == '-inplace':
+            inplace = 1
+
+        elif arg == '-yes':
+            confirmed = 1
+
         elif arg == '-pct':
             copy_pct = 1
 
@@ -271,6 +331,16 @@ if __name__ == '__main__':
     if len(names) > 1:
         print 'You can only select one file to flip at a time'
         sys.exit(1)
+
+    if inplace != 0:
+        if confirmed == 0:
+            print '-inplace modifies %s and leaves it south-up; add -yes to go ahead,' % names[0]
+            print 'or leave out -inplace to write the flipped raster to a new file.'
+            sys.exit( 1 )
+        if flip_in_place( names[0] ) != 1:
+            print 'Format of %s does not allow rewriting the geotransform in place, flip to a new file instead.' % names[0]
+            sys.exit( 1 )
+        sys.exit( 0 )
         
     Driver = gdal.GetDriverByName(format)
     if Driver is None:
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""
+ focal.py
+ Focal (moving window) statistics over rectangular and circular
+ neighbourhoods, streamed through large rasters in strips with a halo.
+
+    python focal.py -s std -n circle -w 7 dem.tif dem_std.tif
+
+ Sums, means and standard deviations come from summed-area tables, so the
+ cost per cell does not grow with the window (circles sum one run of cells
+ per window row). Min and max use the van Herk/Gil-Werman running extreme,
+ three comparisons per cell whatever the window width.
+
+ Nodata cells and cells past the raster edge are left out of every
+ statistic. Windows with no valid cells come back as nodata.
+
+ From other scripts:
+
+    from focal import focal_array, neighbourhood, focal_block
+    std = focal_array(dem, 'std', 'circle', 7)
+"""
+import sys
+import optparse
+import numpy
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+STATS = ('sum', 'mean', 'min', 'max', 'std', 'range', 'count')
+SHAPES = ('rect', 'circle')
+
+NODATA = -9999
+
+# Rows per strip are rounded up to whole blocks of the input
+STRIP_ROWS = 256
+
+def neighbourhood(shape='rect', size=3):
+    """
+    Describe a window as runs of cells, one (dy, dx0, dx1) per window row,
+    relative to the centre cell
+
+    size is the odd width of the window, or (rows, cols) for a rectangle.
+    Circles take in cells whose centre is within about size/2 cells.
+    """
+    if shape == 'rect':
+        if isinstance(size, int):
+            size = (size, size)
+        ry, rx = size[0] / 2, size[1] / 2
+        return [(dy, -rx, rx) for dy in range(-ry, ry + 1)]
+    elif shape == 'circle':
+        r = size / 2
+        runs = []
+        for dy in range(-r, r + 1):
+            h = int(numpy.sqrt(r * r + r - dy * dy))
+            runs.append((dy, -h, h))
+        return runs
+    raise ValueError("Unknown neighbourhood shape '%s'" % shape)
+
+def halo(runs):
+    """ Return the (rows, cols) of padding a window needs on each side """
+    return (max([abs(r[0]) for r in runs]),
+            max([max(-r[1], r[2]) for r in runs]))
+
+def _is_rect(runs):
+    return len(set([(r[1], r[2]) for r in runs])) == 1
+
+def _window_sums(a, runs, rows, cols):
+    """
+    Sum a over the window around each interior cell of the haloed array a
+    """
+    ry, rx = halo(runs)
+    if _is_rect(runs):
+        # Summed-area table: four lookups per cell
+        s = numpy.zeros((a.shape[0] + 1, a.shape[1] + 1))
+        s[1:, 1:] = a.cumsum(axis=0).cumsum(axis=1)
+        ny = len(runs)
+        x0 = rx + runs[0][1]
+        x1 = rx + runs[0][2] + 1
+        return (s[ny:ny + rows, x1:x1 + cols] - s[:rows, x1:x1 + cols] -
+                s[ny:ny + rows, x0:x0 + cols] + s[:rows, x0:x0 + cols])
+
+    # Running sums along each row, two lookups per window row
+    s = numpy.zeros((a.shape[0], a.shape[1] + 1))
+    s[:, 1:] = a.cumsum(axis=1)
+    total = numpy.zeros((rows, cols))
+    for dy, dx0, dx1 in runs:
+        y = ry + dy
+        total += s[y:y + rows, rx + dx1 + 1:rx + dx1 + 1 + cols]
+        total -= s[y:y + rows, rx + dx0:rx + dx0 + cols]
+    return total
+
+def sliding_extreme(a, width, ufunc, fill):
+    """
+    Running ufunc (numpy.maximum or numpy.minimum) of width cells along
+    the rows of a, by van Herk/Gil-Werman. Returns cols - width + 1 values
+    per row.
+    """
+    rows, cols = a.shape
+    if width == 1:
+        return a.copy()
+    nblocks = (cols + width - 1) / width
+    padded = numpy.empty((rows, nblocks * width), dtype=a.dtype)
+    padded.fill(fill)
+    padded[:, :cols] = a
+    blocks = padded.reshape(rows, nblocks, width)
+
+    # Extreme so far from the start and from the end of each block
+    prefix = ufunc.accumulate(blocks, axis=2).reshape(rows, -1)
+    suffix = ufunc.accumulate(blocks[:, :, ::-1], axis=2)[:, :, ::-1].reshape(rows, -1)
+
+    n = cols - width + 1
+    return ufunc(suffix[:, :n], prefix[:, width - 1:width - 1 + n])
+
+def _window_extreme(a, runs, rows, cols, ufunc, fill):
+    ry, rx = halo(runs)
+    if _is_rect(runs):
+        # Separable: along the rows, then down the columns
+        across = sliding_extreme(a, runs[0][2] - runs[0][1] + 1, ufunc, fill)
+        x0 = rx + runs[0][1]
+        across = across[:, x0:x0 + cols]
+        return sliding_extreme(across.T, len(runs), ufunc, fill).T
+
+    out = None
+    widths = {}
+    for dy, dx0, dx1 in runs:
+        width = dx1 - dx0 + 1
+        if width not in widths:
+            widths[width] = sliding_extreme(a, width, ufunc, fill)
+        y = ry + dy
+        run = widths[width][y:y + rows, rx + dx0:rx + dx0 + cols]
+        if out is None:
+            out = run.copy()
+        else:
+            out = ufunc(out, run)
+    return out
+
+def focal_block(data, valid, stat, runs):
+    """
+    Compute stat over the window described by runs for the interior of
+    data. data and valid carry halo(runs) extra cells on every side.
+
+    Returns a float64 array, NaN where the window holds no valid cells.
+    """
+    ry, rx = halo(runs)
+    rows = data.shape[0] - 2 * ry
+    cols = data.shape[1] - 2 * rx
+    data = data.astype(numpy.float64)
+
+    count = _window_sums(valid.astype(numpy.float64), runs, rows, cols)
+    empty = count < 0.5
+
+    if stat == 'count':
+        out = count
+    elif stat in ('sum', 'mean', 'std'):
+        # Centre the values first so the variance does not cancel away
+        offset = 0.0
+        if valid.any():
+            offset = data[valid].mean()
+        values = numpy.where(valid, data - offset, 0.0)
+        total = _window_sums(values, runs, rows, cols)
+        safe = numpy.where(empty, 1.0, count)
+        if stat == 'sum':
+            out = total + offset * count
+        elif stat == 'mean':
+            out = total / safe + offset
+        else:
+            squares = _window_sums(values * values, runs, rows, cols)
+            mean = total / safe
+            out = numpy.sqrt(numpy.maximum(squares / safe - mean * mean, 0.0))
+    elif stat in ('min', 'max', 'range'):
+        if stat != 'min':
+            high = _window_extreme(numpy.where(valid, data, -numpy.inf), runs,
+                                   rows, cols, numpy.maximum, -numpy.inf)
+        if stat != 'max':
+            low = _window_extreme(numpy.where(valid, data, numpy.inf), runs,
+                                  rows, cols, numpy.minimum, numpy.inf)
+        if stat == 'min':
+            out = low
+        elif stat == 'max':
+            out = high
+        else:
+            out = high - low
+    else:
+        raise ValueError("Unknown focal statistic '%s'" % stat)
+
+    out = numpy.array(out, dtype=numpy.float64)
+    out[empty] = numpy.nan
+    return out
+
+def valid_cells(a, nodata):
+    """ Mask of the cells in a that are not nodata or NaN """
+    valid = numpy.ones(a.shape, dtype=bool)
+    if nodata is not None:
+        valid = a != nodata
+    if a.dtype.kind == 'f':
+        valid &= ~numpy.isnan(a)
+    return valid
+
+def focal_array(a, stat, shape='rect', size=3, nodata=None):
+    """
+    Focal statistic of a whole in-memory array, same shape as a
+    """
+    runs = neighbourhood(shape, size)
+    ry, rx = halo(runs)
+    pad = ((ry, ry), (rx, rx))
+    valid = numpy.pad(valid_cells(a, nodata), pad, 'constant')
+    return focal_block(numpy.pad(a, pad, 'constant'), valid, stat, runs)
+
+def read_with_halo(band, yoff, rows, ry, rx, nodata):
+    """
+    Read full-width rows yoff:yoff+rows with ry rows and rx columns of halo
+    around them. Cells past the raster edges are padded and marked invalid.
+    """
+    top = max(0, yoff - ry)
+    bottom = min(band.YSize, yoff + rows + ry)
+    a = band.ReadAsArray(0, top, band.XSize, bottom - top)
+
+    pad = ((ry - (yoff - top), ry - (bottom - yoff - rows)), (rx, rx))
+    return (numpy.pad(a, pad, 'constant'),
+            numpy.pad(valid_cells(a, nodata), pad, 'constant'))
+
+def focal_raster(band, dst_band, stat, shape='rect', size=3, nodata=NODATA,
+                 strip_rows=STRIP_ROWS):
+    """
+    Stream a band through focal_block a strip of rows at a time, writing
+    Float32 strips to dst_band with nodata where there were no valid cells
+    """
+    runs = neighbourhood(shape, size)
+    ry, rx = halo(runs)
+    in_nodata = band.GetNoDataValue()
+
+    blocky = band.GetBlockSize()[1]
+    strip = max(1, (strip_rows + blocky - 1) / blocky) * blocky
+
+    for yoff in range(0, band.YSize, strip):
+        rows = min(strip, band.YSize - yoff)
+        data, valid = read_with_halo(band, yoff, rows, ry, rx, in_nodata)
+        out = focal_block(data, valid, stat, runs)
+        out[numpy.isnan(out)] = nodata
+        dst_band.WriteArray(out.astype(numpy.float32), 0, yoff)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser('usage: focal.py [options] input output')
+    parser.add_option('-s', '--stat', dest='stat', default='mean',
+                      help='one of %s [default: mean]' % ', '.join(STATS))
+    parser.add_option('-n', '--neighbourhood', dest='shape', default='rect',
+                      help='rect or circle [default: rect]')
+    parser.add_option('-w', '--window', dest='window', type='int', default=3,
+                      help='window width in cells, odd [default: 3]')
+    parser.add_option('-f', '--format', dest='format', default='GTiff',
+                      help='output format [default: GTiff]')
+    (options, args) = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error('need an input and an output raster')
+    if options.stat not in STATS:
+        parser.error('stat must be one of %s' % ', '.join(STATS))
+    if options.shape not in SHAPES:
+        parser.error('neighbourhood must be one of %s' % ', '.join(SHAPES))
+    if options.window < 1 or options.window % 2 == 0:
+        parser.error('window must be a positive odd number')
+
+    ds = gdal.Open(args[0])
+    if ds is None:
+        print 'Could not open %s' % args[0]
+        sys.exit(1)
+
+    driver = gdal.GetDriverByName(options.format)
+    dst_ds = driver.Create(args[1], ds.RasterXSize, ds.RasterYSize, 1, gdal.GDT_Float32)
+    dst_ds.SetGeoTransform(ds.GetGeoTransform())
+    dst_ds.SetProjection(ds.GetProjection())
+    dst_band = dst_ds.GetRasterBand(1)
+    dst_band.SetNoDataValue(NODATA)
+
+    focal_raster(ds.GetRasterBand(1), dst_band, options.stat, options.shape, options.window)
+    dst_band = None
+    dst_ds = None
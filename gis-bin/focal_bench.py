@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+ focal_bench.py
+ Check focal.py's summed-area sums and running min/max against a brute
+ force pass over every window, on random grids with nodata, then time
+ focal_array() on a larger one.
+
+    python focal_bench.py [size] [trials]
+"""
+import sys
+import time
+import numpy
+from focal import focal_array, neighbourhood, STATS, SHAPES
+
+NODATA = -9999
+
+def brute_focal(a, stat, shape, size, nodata):
+    """ The same statistic, cell by cell, from the neighbourhood runs """
+    runs = neighbourhood(shape, size)
+    rows, cols = a.shape
+    valid = a != nodata
+    out = numpy.empty(a.shape)
+    out.fill(numpy.nan)
+    for y in range(rows):
+        for x in range(cols):
+            values = []
+            for dy, dx0, dx1 in runs:
+                if not 0 <= y + dy < rows:
+                    continue
+                x0 = max(0, x + dx0)
+                x1 = min(cols, x + dx1 + 1)
+                values.extend(a[y + dy, x0:x1][valid[y + dy, x0:x1]].tolist())
+            if not values:
+                continue
+            values = numpy.array(values, dtype=numpy.float64)
+            if stat == 'sum':
+                out[y, x] = values.sum()
+            elif stat == 'mean':
+                out[y, x] = values.mean()
+            elif stat == 'min':
+                out[y, x] = values.min()
+            elif stat == 'max':
+                out[y, x] = values.max()
+            elif stat == 'std':
+                out[y, x] = values.std()
+            elif stat == 'range':
+                out[y, x] = values.max() - values.min()
+            elif stat == 'count':
+                out[y, x] = len(values)
+    return out
+
+def random_grid(rng):
+    """ A small grid, sometimes far from zero, with some nodata """
+    rows = rng.randint(1, 30)
+    cols = rng.randint(1, 30)
+    a = rng.normal(0, 50, (rows, cols))
+    if rng.rand() < 0.5:
+        a += 10000
+    a[rng.rand(rows, cols) < 0.15] = NODATA
+    return a
+
+def same(out, expected, scale):
+    if not numpy.array_equal(numpy.isnan(out), numpy.isnan(expected)):
+        return False
+    found = ~numpy.isnan(expected)
+    return numpy.allclose(out[found], expected[found], rtol=1e-6, atol=1e-6 * scale)
+
+def check(trials, seed=0):
+    """ Compare trials random cases of every stat and shape, return the failures """
+    rng = numpy.random.RandomState(seed)
+    failures = []
+    for trial in range(trials):
+        a = random_grid(rng)
+        scale = max(1.0, numpy.abs(a[a != NODATA]).max() if (a != NODATA).any() else 1.0)
+        for shape in SHAPES:
+            size = int(rng.choice([1, 3, 5, 7, 9, 15]))
+            if shape == 'rect' and rng.rand() < 0.3:
+                size = (int(rng.choice([1, 3, 5])), int(rng.choice([1, 3, 7, 11])))
+            for stat in STATS:
+                out = focal_array(a, stat, shape, size, NODATA)
+                if not same(out, brute_focal(a, stat, shape, size, NODATA), scale):
+                    failures.append((trial, a.shape, stat, shape, size))
+    return failures
+
+if __name__ == '__main__':
+    size = 2048
+    trials = 40
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        trials = int(sys.argv[2])
+
+    print 'checking %d random grids against brute force...' % trials
+    failures = check(trials)
+
+    a = numpy.random.RandomState(1).normal(0, 50, (size, size))
+    for stat in STATS:
+        for shape in SHAPES:
+            start = time.time()
+            focal_array(a, stat, shape, 15)
+            print '%5s %6s 15x15 on %d x %d: %.2f s' % (stat, shape, size, size, time.time() - start)
+
+    if failures:
+        for failure in failures:
+            print 'MISMATCH trial %d, %s grid, %s %s %s' % failure
+        sys.exit(1)
+    print 'outputs match'
@@ -3,7 +3,11 @@
 # http://zcologia.com/news/16
 #
 # Create footprint shapefile
+#  python footprints.py                  footprints of *.tif here
+#  python footprints.py catalog.sqlite   footprints of every raster in a
+#                                        gdal_catalog.py -db catalog
 import ogr
+import sys
 
 driver = ogr.GetDriverByName('ESRI Shapefile')
 footprints_shp = driver.CreateDataSource('index/')
@@ -17,18 +21,27 @@ footprints.CreateField(fd)
 import glob
 import gdal
 
-files = glob.glob('*.tif')
-for file in files:
-    # Get georeferencing and size of imagery
-    dataset = gdal.Open(file)
-    g = dataset.GetGeoTransform()
-    pixels = dataset.RasterXSize
-    lines = dataset.RasterYSize
-    minx = g[0]
-    maxx = minx + pixels * g[1]
-    maxy = g[3]
-    miny = maxy + lines * g[5]
-    
+def image_extents(files):
+    for file in files:
+        # Get georeferencing and size of imagery
+        dataset = gdal.Open(file)
+        g = dataset.GetGeoTransform()
+        pixels = dataset.RasterXSize
+        lines = dataset.RasterYSize
+        minx = g[0]
+        maxx = minx + pixels * g[1]
+        maxy = g[3]
+        miny = maxy + lines * g[5]
+        yield file, minx, miny, maxx, maxy
+
+if len(sys.argv) > 1:
+    # Extents are already in the catalog, no need to open the rasters
+    from catalog_db import CatalogDB
+    extents = CatalogDB(sys.argv[1]).raster_extents()
+else:
+    extents = image_extents(glob.glob('*.tif'))
+
+for file, minx, miny, maxx, maxy in extents:
     # append to the 'footprints' layer
     wkt = 'POLYGON ((%f %f, %f %f, %f %f, %f %f, %f %f))' \
         % (minx, miny, minx, maxy, maxx, maxy, maxx, miny, minx, miny)
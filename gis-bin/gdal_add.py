@@ -28,17 +28,43 @@
 ###############################################################################
 
 import gdal
+import numpy
 import sys
+from multiprocessing.pool import ThreadPool
+from extent_index import ExtentIndex
 
 verbose = 0
 
+# Target pixels summed in memory per window, along each axis
+BLOCK_SIZE = 1024
+
+# Threads opening source headers in names_to_fileinfos
+THREADS = 8
+
+# =============================================================================
+def accumulate( total, empty, data, nodata ):
+    """
+    Add the valid pixels of data into total, in place.
+
+    total -- float array being summed into.
+    empty -- boolean array flagging total pixels that still hold the target
+    nodata value; these are replaced rather than added to, then cleared.
+    data -- source pixels, the same shape as total.
+    nodata -- source value to skip, NaNs are always skipped.
+    """
+    valid = ~numpy.isnan(data)
+    if nodata is not None:
+        valid &= data != nodata
+
+    total[valid & empty] = 0
+    total[valid] += data[valid]
+    empty &= ~valid
+
 # =============================================================================
 def raster_add( s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
                              t_fh, t_xoff, t_yoff, t_xsize, t_ysize, t_band_n,
                              nodata ):
 
-    import Numeric
-    
     if verbose != 0:
         print 'Copy %d,%d,%d,%d to %d,%d,%d,%d.' \
               % (s_xoff, s_yoff, s_xsize, s_ysize,
@@ -47,37 +73,141 @@ def raster_add( s_fh, s_xoff, s_yoff, s_xsize, s_ysize, s_band_n,
     s_band = s_fh.GetRasterBand( s_band_n )
     t_band = t_fh.GetRasterBand( t_band_n )
 
+    if nodata is None:
+        nodata = s_band.GetNoDataValue()
+
     data_src = s_band.ReadAsArray( s_xoff, s_yoff, s_xsize, s_ysize,
                                    t_xsize, t_ysize )
     data_dst = t_band.ReadAsArray( t_xoff, t_yoff, t_xsize, t_ysize )
 
-    nodata_test = Numeric.equal(data_src,s_band.GetNoDataValue())
-    data_src_fill = Numeric.choose( nodata_test, (data_src, 0) )
-   
-    to_write = Numeric.add(data_src_fill,data_dst)
+    to_write = data_dst.astype( numpy.float64 )
+    empty = numpy.zeros( to_write.shape, dtype=bool )
+    if t_band.GetNoDataValue() is not None:
+        empty = data_dst == t_band.GetNoDataValue()
+
+    accumulate( to_write, empty, data_src, nodata )
                                
     t_band.WriteArray( to_write, t_xoff, t_yoff )
     
     return 0
 
 # =============================================================================
-def names_to_fileinfos( names ):
+def mosaic_add( t_fh, t_band_n, sources, nodata = None,
+                block_size = BLOCK_SIZE ):
+    """
+    Sum sources into one band of the target, a block at a time.
+
+    The target grid is walked in windows aligned to its native blocks.  For
+    each window the overlapping sources are found in an ExtentIndex, all of
+    them are added up in memory and the window is written once.
+
+    t_fh -- gdal.Dataset to sum into.
+    t_band_n -- target band number.
+    sources -- list of (file_info, source band number) to add.
+    nodata -- source value to ignore, defaults to each source band's own.
+    """
+    t_band = t_fh.GetRasterBand( t_band_n )
+    t_nodata = t_band.GetNoDataValue()
+    t_geotransform = t_fh.GetGeoTransform()
+
+    index = ExtentIndex( [fi for fi, band in sources] )
+
+    # Whole native blocks per window, unless a block alone is too big
+    bx, by = t_band.GetBlockSize()
+    xstep, ystep = block_size, block_size
+    if bx <= block_size:
+        xstep = block_size / bx * bx
+    if by <= block_size:
+        ystep = block_size / by * by
+
+    s_fhs = {}
+    for yoff in range(0, t_fh.RasterYSize, ystep):
+        ysize = min( ystep, t_fh.RasterYSize - yoff )
+        row_fhs = {}
+
+        for xoff in range(0, t_fh.RasterXSize, xstep):
+            xsize = min( xstep, t_fh.RasterXSize - xoff )
+
+            x0 = t_geotransform[0] + xoff * t_geotransform[1]
+            x1 = t_geotransform[0] + (xoff + xsize) * t_geotransform[1]
+            y0 = t_geotransform[3] + yoff * t_geotransform[5]
+            y1 = t_geotransform[3] + (yoff + ysize) * t_geotransform[5]
+
+            hits = index.query_ids( min(x0, x1), min(y0, y1),
+                                    max(x0, x1), max(y0, y1) )
+            if len(hits) == 0:
+                continue
+
+            total = None
+            for i in hits:
+                fi, s_band_n = sources[i]
+                windows = fi.windows( t_geotransform, xoff, yoff, xsize, ysize )
+                if windows is None:
+                    continue
+                sw_xoff, sw_yoff, sw_xsize, sw_ysize, \
+                    tw_xoff, tw_yoff, tw_xsize, tw_ysize = windows
+
+                if total is None:
+                    data_dst = t_band.ReadAsArray( xoff, yoff, xsize, ysize )
+                    total = data_dst.astype( numpy.float64 )
+                    empty = numpy.zeros( total.shape, dtype=bool )
+                    if t_nodata is not None:
+                        empty = data_dst == t_nodata
+
+                if fi.filename not in s_fhs:
+                    s_fhs[fi.filename] = gdal.Open( fi.filename )
+                row_fhs[fi.filename] = s_fhs[fi.filename]
+                s_band = s_fhs[fi.filename].GetRasterBand( s_band_n )
+
+                s_nodata = nodata
+                if s_nodata is None:
+                    s_nodata = s_band.GetNoDataValue()
+
+                data_src = s_band.ReadAsArray( sw_xoff, sw_yoff, sw_xsize, sw_ysize,
+                                               tw_xsize, tw_ysize )
+
+                ty = tw_yoff - yoff
+                tx = tw_xoff - xoff
+                accumulate( total[ty:ty+tw_ysize, tx:tx+tw_xsize],
+                            empty[ty:ty+tw_ysize, tx:tx+tw_xsize],
+                            data_src, s_nodata )
+
+            if total is not None:
+                t_band.WriteArray( total, xoff, yoff )
+
+        # Only keep sources open while the walk is still crossing them
+        s_fhs = row_fhs
+
+    return 0
+
+# =============================================================================
+def names_to_fileinfos( names, threads = THREADS ):
     """
     Translate a list of GDAL filenames, into file_info objects.
 
     names -- list of valid GDAL dataset names.
+    threads -- number of threads opening file headers at once.
 
-    Returns a list of file_info objects.  There may be less file_info objects
-    than names if some of the names could not be opened as GDAL files.
+    Returns a list of file_info objects, in the same order as names.  There
+    may be less file_info objects than names if some of the names could not
+    be opened as GDAL files.
     """
-    
-    file_infos = []
-    for name in names:
+
+    def load( name ):
         fi = file_info()
         if fi.init_from_name( name ) == 1:
-            file_infos.append( fi )
+            return fi
+        return None
+
+    if threads > 1 and len(names) > 1:
+        pool = ThreadPool( min(threads, len(names)) )
+        loaded = pool.map( load, names )
+        pool.close()
+        pool.join()
+    else:
+        loaded = map( load, names )
 
-    return file_infos
+    return [fi for fi in loaded if fi is not None]
 
 # *****************************************************************************
 class file_info:
@@ -124,29 +254,21 @@ class file_info:
         print 'UL:(%f,%f)   LR:(%f,%f)' \
               % (self.ulx,self.uly,self.lrx,self.lry)
 
-    def copy_into( self, t_fh, s_band = 1, t_band = 1, nodata_arg=None ):
+    def windows( self, t_geotransform, t_xoff, t_yoff, t_xsize, t_ysize ):
         """
-        Copy this files image into target file.
+        Compute where this file overlaps a window of the target grid.
 
-        This method will compute the overlap area of the file_info objects
-        file, and the target gdal.Dataset object, and copy the image data
-        for the common window area.  It is assumed that the files are in
-        a compatible projection ... no checking or warping is done.  However,
-        if the destination file is a different resolution, or different
-        image pixel type, the appropriate resampling and conversions will
-        be done (using normal GDAL promotion/demotion rules).
-
-        t_fh -- gdal.Dataset object for the file into which some or all
-        of this file may be copied.
+        t_geotransform -- geotransform of the target grid.
+        t_xoff, t_yoff, t_xsize, t_ysize -- target window in pixels.
 
-        Returns 1 on success (or if nothing needs to be copied), and zero one
-        failure.
+        Returns (sw_xoff, sw_yoff, sw_xsize, sw_ysize, tw_xoff, tw_yoff,
+        tw_xsize, tw_ysize), the source and target windows in pixels, or
+        None if the file does not overlap the target window.
         """
-        t_geotransform = t_fh.GetGeoTransform()
-        t_ulx = t_geotransform[0]
-        t_uly = t_geotransform[3]
-        t_lrx = t_geotransform[0] + t_fh.RasterXSize * t_geotransform[1]
-        t_lry = t_geotransform[3] + t_fh.RasterYSize * t_geotransform[5]
+        t_ulx = t_geotransform[0] + t_xoff * t_geotransform[1]
+        t_uly = t_geotransform[3] + t_yoff * t_geotransform[5]
+        t_lrx = t_ulx + t_xsize * t_geotransform[1]
+        t_lry = t_uly + t_ysize * t_geotransform[5]
 
         # figure out intersection region
         tgw_ulx = max(t_ulx,self.ulx)
@@ -160,11 +282,11 @@ class file_info:
         
         # do they even intersect?
         if tgw_ulx >= tgw_lrx:
-            return 1
+            return None
         if t_geotransform[5] < 0 and tgw_uly <= tgw_lry:
-            return 1
+            return None
         if t_geotransform[5] > 0 and tgw_uly >= tgw_lry:
-            return 1
+            return None
             
         # compute target window in pixel coordinates.
         tw_xoff = int((tgw_ulx - t_geotransform[0]) / t_geotransform[1] + 0.1)
@@ -175,7 +297,7 @@ class file_info:
                    - tw_yoff
 
         if tw_xsize < 1 or tw_ysize < 1:
-            return 1
+            return None
 
         # Compute source window in pixel coordinates.
         sw_xoff = int((tgw_ulx - self.geotransform[0]) / self.geotransform[1])
@@ -186,8 +308,37 @@ class file_info:
                        / self.geotransform[5] + 0.5) - sw_yoff
 
         if sw_xsize < 1 or sw_ysize < 1:
+            return None
+
+        return (sw_xoff, sw_yoff, sw_xsize, sw_ysize,
+                tw_xoff, tw_yoff, tw_xsize, tw_ysize)
+
+    def copy_into( self, t_fh, s_band = 1, t_band = 1, nodata_arg=None ):
+        """
+        Copy this files image into target file.
+
+        This method will compute the overlap area of the file_info objects
+        file, and the target gdal.Dataset object, and copy the image data
+        for the common window area.  It is assumed that the files are in
+        a compatible projection ... no checking or warping is done.  However,
+        if the destination file is a different resolution, or different
+        image pixel type, the appropriate resampling and conversions will
+        be done (using normal GDAL promotion/demotion rules).
+
+        t_fh -- gdal.Dataset object for the file into which some or all
+        of this file may be copied.
+
+        Returns 1 on success (or if nothing needs to be copied), and zero one
+        failure.
+        """
+        windows = self.windows( t_fh.GetGeoTransform(), 0, 0,
+                                t_fh.RasterXSize, t_fh.RasterYSize )
+        if windows is None:
             return 1
 
+        sw_xoff, sw_yoff, sw_xsize, sw_ysize, \
+            tw_xoff, tw_yoff, tw_xsize, tw_ysize = windows
+
         # Open the source file, and copy the selected region.
         s_fh = gdal.Open( self.filename )
 
@@ -202,7 +353,8 @@ def Usage():
     print 'Usage: gdal_add.py [-o out_filename] [-of out_format] [-co NAME=VALUE]*'
     print '                     [-ps pixelsize_x pixelsize_y] [-separate] [-v] [-pct]'
     print '                     [-ul_lr ulx uly lrx lry] [-n nodata_value] [-init value]'
-    print '                     [-ot datatype] [-createonly] input_files'
+    print '                     [-ot datatype] [-createonly] [-threads n]'
+    print '                     [-catalog catalog.sqlite] input_files'
     print '                     [--help-general]'
     print
 
@@ -226,6 +378,8 @@ if __name__ == '__main__':
     pre_init = None
     band_type = None
     createonly = 0
+    threads = THREADS
+    catalog = None
 
     gdal.AllRegister()
     argv = gdal.GeneralCmdLineProcessor( sys.argv )
@@ -263,6 +417,14 @@ if __name__ == '__main__':
                 print 'Unknown GDAL data type: ', argv[i]
                 sys.exit( 1 )
 
+        elif arg == '-threads':
+            i = i + 1
+            threads = int(argv[i])
+
+        elif arg == '-catalog':
+            i = i + 1
+            catalog = argv[i]
+
         elif arg == '-init':
             i = i + 1
             pre_init = float(argv[i])
@@ -306,6 +468,16 @@ if __name__ == '__main__':
             
         i = i + 1
 
+    # Take the inputs covering the output extent from a catalog database
+    if catalog is not None:
+        if ulx is None:
+            print '-catalog needs the output extent from -ul_lr.'
+            sys.exit( 1 )
+        from catalog_db import CatalogDB
+        db = CatalogDB( catalog )
+        names.extend( db.rasters_in_bbox( min(ulx,lrx), min(uly,lry), max(ulx,lrx), max(uly,lry) ) )
+        db.close()
+
     if len(names) == 0:
         print 'No input files selected.'
         Usage()
@@ -322,7 +494,7 @@ if __name__ == '__main__':
         sys.exit( 1 )
 
     # Collect information on all the source files.
-    file_infos = names_to_fileinfos( names )
+    file_infos = names_to_fileinfos( names, threads )
 
     if ulx is None:
         ulx = file_infos[0].ulx
@@ -345,7 +517,7 @@ if __name__ == '__main__':
 
     # Try opening as an existing file.
     gdal.PushErrorHandler( 'CPLQuietErrorHandler' )
-    t_fh = gdal.Open( out_file, gdal.GA_ReadOnly )
+    t_fh = gdal.Open( out_file, gdal.GA_Update )
     gdal.PopErrorHandler()
     
     # Create output file if it does not already exist.
@@ -382,22 +554,19 @@ if __name__ == '__main__':
         for i in range(t_fh.RasterCount):
             t_fh.GetRasterBand(i+1).Fill( pre_init )
 
-    # Copy data from source files into output file.
-    t_band = 1
-    for fi in file_infos:
-        if createonly != 0:
-            continue
-        
+    # Sum data from source files into output file.
+    if createonly == 0:
         if verbose != 0:
-            print
-            fi.report()
+            for fi in file_infos:
+                print
+                fi.report()
 
         if separate == 0 :
             for band in range(1, bands+1):
-                fi.copy_into( t_fh, band, band, nodata )
+                mosaic_add( t_fh, band, [(fi, band) for fi in file_infos], nodata )
         else:
-            fi.copy_into( t_fh, 1, t_band, nodata )
-            t_band = t_band+1
+            for t_band, fi in enumerate(file_infos):
+                mosaic_add( t_fh, t_band+1, [(fi, 1)], nodata )
             
     # Force file to be closed.
     t_fh = None
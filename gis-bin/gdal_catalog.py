@@ -14,113 +14,196 @@
 #
 
 import gdal, ogr, os, sys
+from multiprocessing.pool import ThreadPool
+from catalog_manifest import Manifest, MISSING, file_key
+from catalog_db import CatalogDB
+
+# Files opened at once
+THREADS = 8
+
+# Layout of the records kept in the manifest
+MANIFEST_VERSION = 2
 
 def usage():
   print
-  print " gdal_catalog.py <path> {output prefix} {forcegeo(0|1)}"
+  print " gdal_catalog.py [-exact] [-threads n] [-manifest file] [-db file.sqlite]"
+  print "                 <path> {output prefix} {forcegeo(0|1)}"
   print
   print " examples:"
   print "  python gdal_catalog.py /home/user/data"
   print "  python gdal_catalog.py /home/user/data myrastercatalog 1"
   print
+  print " Band min/max are approximate (from overviews or a sample) unless -exact"
+  print " is given. What was found in each file is kept in <prefix>_rmanifest.json"
+  print " so that re-runs only open files whose time or size changed."
+  print " With -db the catalog is also written to a SQLite database with an"
+  print " R-tree on raster extents (see catalog_db.py)."
+  print
   sys.exit(1)
 
-def walkall(walkloc,dsfileout,bdfileout,forcegeo):
+def candidates(walkloc):
+  # Each folder's subdirectories, then its files
+  for walkdirs in walkloc:
+    topdir = walkdirs[0]
+    dirs = walkdirs[1]
+    files = walkdirs[2]
+    for walkdir in dirs:
+      yield os.path.join(topdir,walkdir)
+    for walkfile in files:
+      yield os.path.join(topdir,walkfile)
+
+def quieterrors():
+  # GDAL error handlers are per thread
+  gdal.PushErrorHandler('CPLQuietErrorHandler')
+
+def walkall(walkloc,dsfileout,bdfileout,forcegeo,manifest=None,exact=False,threads=THREADS,db=None,root=None):
   # The following counters will be used for generating
   #  unique datasource and layer ids (i.e. primary keys)
   dscounter = 0
+  if manifest is None:
+    manifest = Manifest(version=MANIFEST_VERSION)
 
   # Open up the output files and output header row
   dsfileout.write('dsid|rasterpath|bandcount|geotransform|drivername|xnumpixels|ynumpixels|projectionwkt\n')
   bdfileout.write('dsid|bandid|min|max|overviews\n')
 
-  # Start walking through all the folders in specified path
-  for walkdirs in walkloc:
-    topdir = walkdirs[0]
-    dirs = walkdirs[1]
-    files = walkdirs[2]
-    for walkdir in dirs:
-      currentpath = os.path.join(topdir,walkdir)
-      if (checkds(currentpath,forcegeo)):
-        dscounter += 1
-        details,bandcount,ds = getdsdetails(currentpath)
-        dsfileout.write('|'.join([str(dscounter),details]))
-        dsfileout.write('\n')
-        for bandnum in range(1,bandcount+1):
-          details = getbanddetails(ds,bandnum)
-          bdfileout.write('|'.join([str(dscounter),str(bandnum),details])) 
-          bdfileout.write('\n');
-    for walkfile in files:
-      currentfile = os.path.join(topdir,walkfile)
-      if (checkds(currentfile,forcegeo)):
-        dscounter += 1
-        details,bandcount,ds = getdsdetails(currentfile)
-        dsfileout.write('|'.join([str(dscounter),details]))
-        dsfileout.write('\n')
-        for bandnum in range(1,bandcount+1):
-          details = getbanddetails(ds,bandnum)
-          bdfileout.write('|'.join([str(dscounter),str(bandnum),details])) 
-          bdfileout.write('\n');
-          
-
-def checkds(filepath,forcegeo):
-  ds = gdal.OpenShared(filepath)
-  if ds is not None:
-    if forcegeo == 1 and ds.GetGeoTransform() == (0, 1, 0, 0, 0, 1):
+  def lookup(filepath):
+    key = file_key(filepath)
+    record = manifest.get(filepath,key)
+    if record is MISSING or (record is not None and exact and not record['exact']):
+      record = scanpath(filepath,exact)
+      manifest.put(filepath,record,key)
+    return filepath, record
+
+  # Rasters stored this scan; with root given, others under it are
+  #  dropped from the db afterwards
+  seen = set()
+
+  # Headers are read in the pool but written out in walk order
+  pool = ThreadPool(threads,quieterrors)
+  for filepath, record in pool.imap(lookup,candidates(walkloc),16):
+    if (checkds(record,forcegeo)):
+      dscounter += 1
+      print "*Cataloguing raster ",filepath
+      dsfileout.write('|'.join([str(dscounter),record['details']]))
+      dsfileout.write('\n')
+      for bandnum in range(1,len(record['bands'])+1):
+        details = record['bands'][bandnum-1]
+        bdfileout.write('|'.join([str(dscounter),str(bandnum),details]))
+        bdfileout.write('\n');
+      if db is not None:
+        db.add_raster(filepath,record['driver'],record['srs'],record['xsize'],record['ysize'],
+                      record['geotransform'],record['bandinfo'])
+        seen.add(filepath)
+  pool.close()
+  pool.join()
+  if db is not None and root is not None:
+    gone = db.remove_missing_rasters(root,seen)
+    if gone:
+      print "*Removed",gone,"rasters no longer found under",root
+
+def scanpath(filepath,exact=False):
+  """
+  Open filepath once and collect everything the catalog needs from it.
+  Returns None if GDAL can't open it.
+  """
+  ds = gdal.Open(filepath)
+  if ds is None:
+    return None
+  details,bandcount,ds = getdsdetails(filepath,ds)
+  bandinfo = [getbandinfo(ds,bandnum,exact) for bandnum in range(1,bandcount+1)]
+  bands = ['|'.join([str(v) for v in info[1:]]) for info in bandinfo]
+  return {'details': details, 'bands': bands, 'exact': exact,
+          'nogeo': ds.GetGeoTransform() == (0, 1, 0, 0, 0, 1),
+          'driver': ds.GetDriver().LongName, 'srs': ds.GetProjection(),
+          'xsize': ds.RasterXSize, 'ysize': ds.RasterYSize,
+          'geotransform': list(ds.GetGeoTransform()), 'bandinfo': bandinfo}
+
+def checkds(record,forcegeo):
+  if record is not None:
+    if forcegeo == 1 and record['nogeo']:
       return False
     else:
       return True
   else:
     return False
 
-def getdsdetails(filepath):
-  ds = gdal.OpenShared(filepath) 
-  print "*Calculating dataset stats for raster ",filepath
+def getdsdetails(filepath,ds=None):
+  if ds is None:
+    ds = gdal.Open(filepath)
   bandcount = ds.RasterCount
   geotrans = ds.GetGeoTransform()
   driver = ds.GetDriver().LongName
   wkt = ds.GetProjection()
   rasterx = ds.RasterXSize
-  rastery = ds.RasterYSize  
+  rastery = ds.RasterYSize
   dsstring = '|'.join([filepath, str(bandcount), str(geotrans),str(driver),str(rasterx),str(rastery),wkt])
   return dsstring, bandcount, ds
 
-def getbanddetails(ds,bandnum):
+def getbandinfo(ds,bandnum,exact=False):
   band = ds.GetRasterBand(bandnum)
-  print "*  Calculating band stats for band number ",bandnum
-  min,max = band.ComputeRasterMinMax()
+  # approx_ok lets GDAL use overviews or a sample instead of every pixel
+  min,max = band.ComputeRasterMinMax(int(not exact))
   overviews = band.GetOverviewCount()
-  bdstring = '|'.join([str(min),str(max),str(overviews)])
-  return bdstring
+  return [gdal.GetDataTypeName(band.DataType),min,max,overviews]
 
 if __name__ == '__main__':
   # This disables error messages to stdout when a datasource can't
   #  be opened
   gdal.PushErrorHandler()
 
+  exact = False
+  threads = THREADS
+  manifestfile = None
+  dbfile = None
+  args = []
+  i = 1
+  while i < len(sys.argv):
+    arg = sys.argv[i]
+    if arg == '-exact':
+      exact = True
+    elif arg == '-threads':
+      i = i + 1
+      threads = int(sys.argv[i])
+    elif arg == '-manifest':
+      i = i + 1
+      manifestfile = sys.argv[i]
+    elif arg == '-db':
+      i = i + 1
+      dbfile = sys.argv[i]
+    else:
+      args.append(arg)
+    i = i + 1
+
   try:
-    basepath = sys.argv[1]
+    basepath = args[0]
   except:
     usage()
 
   # Do we require that all raster sources have a geographic transformation?
   # forcegeo = 1  => yes
   try:
-    forcegeo = sys.argv[3]
+    forcegeo = int(args[2])
   except:
     forcegeo = 0
 
   # Set up the output file that will be created
   try:
-    prefix = sys.argv[2]
+    prefix = args[1]
   except:
     prefix = 'raster'
   dstxt = '_'.join([prefix,'rds.txt'])
   bdtxt = '_'.join([prefix,'rbd.txt'])
+  if manifestfile is None:
+    manifestfile = '_'.join([prefix,'rmanifest.json'])
   print ' '.join(['*Opening output files:',dstxt,bdtxt])
   print ' '.join(['*Searching',basepath,'for raster datasets ...'])
   dsfileout = open(dstxt, 'w')
   bdfileout = open(bdtxt, 'w')
+  manifest = Manifest(manifestfile,MANIFEST_VERSION)
+  db = None
+  if dbfile is not None:
+    db = CatalogDB(dbfile)
 
   # Below, walkloc holds a list of a string and two arrays:
   #   walkloc.next[0] - top level "current" walk dir (string)
@@ -129,8 +212,12 @@ if __name__ == '__main__':
   #   walkloc.next cycles through every folder in [1]
   # Top dir comes from 1st command line argument
   walkloc = os.walk(basepath)
-  walkall(walkloc,dsfileout,bdfileout,forcegeo)
+  walkall(walkloc,dsfileout,bdfileout,forcegeo,manifest,exact,threads,db,basepath)
+  manifest.save()
+  if db is not None:
+    db.close()
 
   #cleanup
   print ' '.join(['*Closing output files:',dstxt,bdtxt])
   dsfileout.close()
+  bdfileout.close()
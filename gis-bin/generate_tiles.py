@@ -2,6 +2,9 @@
 from math import pi,cos,sin,log,exp,atan
 from subprocess import call
 import sys, os
+import multiprocessing
+import numpy
+from tile_store import open_store
 
 DEG_TO_RAD = pi/180
 RAD_TO_DEG = 180/pi
@@ -11,6 +14,10 @@ def minmax (a,b,c):
     a = min(a,c)
     return a
 
+def round_half_away(a):
+    """ round() for arrays, rounding halves away from zero as round() does """
+    return numpy.sign(a) * numpy.floor(numpy.abs(a) + 0.5)
+
 class GoogleProjection:
     def __init__(self,levels=18):
         self.Bc = []
@@ -40,68 +47,305 @@ class GoogleProjection:
          h = RAD_TO_DEG * ( 2 * atan(exp(g)) - 0.5 * pi)
          return (f,h)
 
+    def fromLLtoPixels(self,lons,lats,zoom):
+         """ fromLLtoPixel for arrays of longitudes and latitudes """
+         d = self.zc[zoom]
+         e = round_half_away(d[0] + numpy.asarray(lons,'d') * self.Bc[zoom])
+         f = numpy.clip(numpy.sin(DEG_TO_RAD * numpy.asarray(lats,'d')),-0.9999,0.9999)
+         g = round_half_away(d[1] + 0.5*numpy.log((1+f)/(1-f))*-self.Cc[zoom])
+         return (e,g)
+
+    def fromPixelsToLL(self,pxs,pys,zoom):
+         """ fromPixelToLL for arrays of pixel x and y """
+         e = self.zc[zoom]
+         f = (numpy.asarray(pxs,'d') - e[0])/self.Bc[zoom]
+         g = (numpy.asarray(pys,'d') - e[1])/-self.Cc[zoom]
+         h = RAD_TO_DEG * ( 2 * numpy.arctan(numpy.exp(g)) - 0.5 * pi)
+         return (f,h)
+
+    def tileBounds(self,xs,ys,zoom,pad=0):
+         """
+         Return arrays (minlon, minlat, maxlon, maxlat) of the tiles xs, ys,
+         each grown by pad pixels all round
+         """
+         xs = numpy.asarray(xs,'d')
+         ys = numpy.asarray(ys,'d')
+         minlon, minlat = self.fromPixelsToLL(xs * 256.0 - pad, (ys+1) * 256.0 + pad, zoom)
+         maxlon, maxlat = self.fromPixelsToLL((xs+1) * 256.0 + pad, ys * 256.0 - pad, zoom)
+         return minlon, minlat, maxlon, maxlat
+
 from mapnik import *
 
-def render_tiles(bbox, mapfile, tile_dir, minZoom=1,maxZoom=18, name="unknown"):
-    print "render_tiles(",bbox, mapfile, tile_dir, minZoom,maxZoom, name,")"
+# Tiles per side of the square chunks handed to each worker
+CHUNK_SIZE = 8
 
-    if not os.path.isdir(tile_dir):
-         os.mkdir(tile_dir)
+# Tiles per side of a metatile, rendered in one go and then cut up. A
+# power of two that divides CHUNK_SIZE
+METATILE = 4
 
-    gprj = GoogleProjection(maxZoom+1) 
-    m = Map(2 * 256,2 * 256)
-    load_map(m,mapfile)
-    prj = Projection("+proj=merc +datum=WGS84")
-    
+# Pixels rendered around a metatile so labels at its edges aren't clipped
+BUFFER = 128
+
+# Tiles planned at a time; bounds the memory used for pruning and the
+# chunk tile lists however large the bbox
+PLAN_TILES = 1 << 20
+
+# Size in bytes of the PNG mapnik writes for a tile with nothing on it
+EMPTY_TILE_SIZE = 137
+
+def tile_ranges(gprj, bbox, minZoom, maxZoom):
+    """
+    Yield (z, x0, x1, y0, y1) with the inclusive tile ranges covering bbox
+    """
     ll0 = (bbox[0],bbox[3])
     ll1 = (bbox[2],bbox[1])
-    
     for z in range(minZoom,maxZoom + 1):
         px0 = gprj.fromLLtoPixel(ll0,z)
         px1 = gprj.fromLLtoPixel(ll1,z)
-        for x in range(int(px0[0]/256.0),int(px1[0]/256.0)+1):
-            for y in range(int(px0[1]/256.0),int(px1[1]/256.0)+1):
-                p0 = gprj.fromPixelToLL((x * 256.0, (y+1) * 256.0),z)
-                p1 = gprj.fromPixelToLL(((x+1) * 256.0, y * 256.0),z)
-
-                # render a new tile and store it on filesystem
-                c0 = prj.forward(Coord(p0[0],p0[1]))
-                c1 = prj.forward(Coord(p1[0],p1[1]))
-            
-                bbox = Envelope(c0.x,c0.y,c1.x,c1.y)
-                bbox.width(bbox.width() * 2)
-                bbox.height(bbox.height() * 2)
-                m.zoom_to_box(bbox)
-                
-                # check if we have directories in place
-                zoom = "%s" % z
-                str_x = "%s" % x
-                str_y = "%s" % y
-
-                if not os.path.isdir(tile_dir + zoom):
-                    os.mkdir(tile_dir + zoom)
-                if not os.path.isdir(tile_dir + zoom + '/' + str_x):
-                    os.mkdir(tile_dir + zoom + '/' + str_x)
-
-                tile_uri = tile_dir + zoom + '/' + str_x + '/' + str_y + '.png'
-
-		exists= ""
-                if os.path.isfile(tile_uri):
-                    exists= "exists"
-                else:
-                    im = Image(512, 512)
-                    render(m, im)
-                    view = im.view(128,128,256,256) # x,y,width,height
-                    save_to_file(tile_uri,'png',view)
-                    #cmd = "convert  -colors 255 %s %s" % (tile_uri,tile_uri)
-                    #call(cmd, shell=True)
-
-                bytes=os.stat(tile_uri)[6]
-		empty= ''
-                if bytes == 137:
-                    empty = " Empty Tile "
-
-                print name,"[",minZoom,"-",maxZoom,"]: " ,z,x,y,"p:",p0,p1,exists, empty
+        yield z, int(px0[0]/256.0), int(px1[0]/256.0), int(px0[1]/256.0), int(px1[1]/256.0)
+
+def level_tiles(x0, x1, y0, y1, size=CHUNK_SIZE, max_tiles=PLAN_TILES):
+    """
+    Yield arrays xs, ys of the tiles in the inclusive ranges, a strip of
+    whole chunk columns at a time so that no strip has much more than
+    max_tiles tiles
+    """
+    columns = max(1, max_tiles / ((y1 - y0 + 1) * size)) * size
+    for sx in range(x0 / size * size, x1 + 1, columns):
+        xs, ys = numpy.mgrid[max(x0, sx):min(x1, sx + columns - 1)+1, y0:y1+1]
+        yield xs.ravel(), ys.ravel()
+
+def tile_keys(xs, ys):
+    """ One integer per tile, for set operations on arrays of tiles """
+    return (numpy.asarray(xs, numpy.int64) << 32) | numpy.asarray(ys, numpy.int64)
+
+def level_chunks(z, xs, ys, size=CHUNK_SIZE, completed=(), skipped=None):
+    """
+    Group the tiles xs, ys of zoom z into chunks of up to size x size
+    tiles, yielding (chunk id, z, [(x, y), ...]) for the chunks whose ids
+    are not in completed. The (cx, cy) of the completed ones are appended
+    to skipped, if given.
+    """
+    if len(xs) == 0:
+        return
+    cxs = xs // size
+    cys = ys // size
+    order = numpy.lexsort((ys, xs, cys, cxs))
+    xs, ys, cxs, cys = xs[order], ys[order], cxs[order], cys[order]
+    starts = numpy.flatnonzero((cxs[1:] != cxs[:-1]) | (cys[1:] != cys[:-1])) + 1
+    bounds = [0] + starts.tolist() + [len(xs)]
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        chunk_id = "%s/%s/%s" % (z, cxs[a], cys[a])
+        if chunk_id not in completed:
+            yield chunk_id, z, zip(xs[a:b].tolist(), ys[a:b].tolist())
+        elif skipped is not None:
+            skipped.append((int(cxs[a]), int(cys[a])))
+
+def prune_tiles(gprj, z, xs, ys, extents=None, empty_ancestors=()):
+    """
+    Return a boolean array marking which of the tiles xs, ys at zoom z are
+    worth rendering: those near one of the extents (if given) and with no
+    ancestor among the empty tiles. empty_ancestors holds (zoom, sorted
+    tile keys) for the levels above z.
+    """
+    keep = numpy.ones(len(xs), bool)
+    if extents:
+        minlon, minlat, maxlon, maxlat = gprj.tileBounds(xs, ys, z, BUFFER)
+        near = numpy.zeros(len(xs), bool)
+        for e in extents:
+            near |= (minlon <= e[2]) & (maxlon >= e[0]) & (minlat <= e[3]) & (maxlat >= e[1])
+        keep &= near
+    for az, keys in empty_ancestors:
+        if len(keys):
+            keep &= ~numpy.in1d(tile_keys(xs >> (z - az), ys >> (z - az)), keys)
+    return keep
+
+def data_extents(mapfile):
+    """
+    Return the lon/lat extents of the mapfile's layers, or None if any of
+    them can't be worked out: every layer is rendered, so pruning on the
+    others would drop the tiles only that layer covers
+    """
+    m = Map(256,256)
+    load_map(m,mapfile)
+    extents = []
+    for layer in m.layers:
+        try:
+            e = layer.envelope()
+            lprj = Projection(layer.srs)
+            corners = [lprj.inverse(Coord(x,y)) for x in (e.minx,e.maxx) for y in (e.miny,e.maxy)]
+        except Exception, err:
+            print "** no extent for layer", layer.name, "- not pruning on extents:", err
+            return None
+        extents.append((min([c.x for c in corners]), min([c.y for c in corners]),
+                        max([c.x for c in corners]), max([c.y for c in corners])))
+    if not extents:
+        return None
+    return extents
+
+# Per-process renderer state, set up once by init_worker
+_worker = {}
+
+def init_worker(mapfile, maxZoom):
+    size = METATILE * 256 + 2 * BUFFER
+    m = Map(size,size)
+    load_map(m,mapfile)
+    _worker['map'] = m
+    # render buffers by size, reused from one metatile to the next
+    _worker['images'] = {size: Image(size, size)}
+    _worker['prj'] = Projection("+proj=merc +datum=WGS84")
+    _worker['gprj'] = GoogleProjection(maxZoom+1)
+
+def render_metatile(m, prj, gprj, z, mx, my, n, tiles, images=None):
+    """
+    Render the n x n tiles from mx, my (plus BUFFER pixels all round) as
+    one image, and return the listed (x, y) tiles cut from it as
+    (x, y, png data). images maps sizes to Images to render into, and
+    gains one for any size it lacks.
+    """
+    p0 = gprj.fromPixelToLL((mx * 256.0 - BUFFER, (my+n) * 256.0 + BUFFER),z)
+    p1 = gprj.fromPixelToLL(((mx+n) * 256.0 + BUFFER, my * 256.0 - BUFFER),z)
+
+    c0 = prj.forward(Coord(p0[0],p0[1]))
+    c1 = prj.forward(Coord(p1[0],p1[1]))
+
+    size = n * 256 + 2 * BUFFER
+    if m.width != size or m.height != size:
+        m.resize(size,size)
+    m.zoom_to_box(Envelope(c0.x,c0.y,c1.x,c1.y))
+
+    if images is None:
+        images = {}
+    im = images.get(size)
+    if im is None:
+        im = images[size] = Image(size, size)
+    else:
+        im.clear()
+    render(m, im)
+    results = []
+    for x, y in tiles:
+        # views share the metatile's pixels, nothing is copied
+        view = im.view(BUFFER + (x - mx) * 256, BUFFER + (y - my) * 256, 256, 256) # x,y,width,height
+        results.append((x, y, view.tostring('png')))
+    return results
+
+def render_chunk(chunk):
+    """
+    Render the (x, y) tiles of a chunk, given as (chunk id, z, tiles), with
+    this process's Map. Returns (chunk id, z, [(x, y, png data), ...])
+    """
+    chunk_id, z, tiles = chunk
+    # metatiles line up with multiples of n, or cover the whole
+    # world at zooms with fewer than METATILE tiles across
+    n = min(METATILE, 2 ** z)
+    metatiles = {}
+    for x, y in tiles:
+        metatiles.setdefault((x / n * n, y / n * n), []).append((x, y))
+    rendered = []
+    for (mx, my), tiles in sorted(metatiles.items()):
+        rendered.extend(render_metatile(_worker['map'], _worker['prj'], _worker['gprj'],
+                                        z, mx, my, n, tiles, _worker['images']))
+    return chunk_id, z, rendered
+
+def render_tiles(bbox, mapfile, tile_dir, minZoom=1,maxZoom=18, name="unknown", processes=1,
+                 prune_extents=False, prune_empty=False):
+    """
+    Render the tiles covering bbox a chunk at a time, in this process or
+    across a pool of processes, into tile_dir as z/x/y.png files or, if
+    tile_dir ends in .mbtiles, into an MBTiles file. Finished chunks are
+    recorded by the store and skipped when the run is restarted.
+
+    prune_extents skips tiles away from the extents of the mapfile's
+    layers. prune_empty skips the children of tiles that came out empty,
+    rendering a zoom level at a time; only use it when nothing in the map
+    appears first at a higher zoom.
+    """
+    print "render_tiles(",bbox, mapfile, tile_dir, minZoom,maxZoom, name, processes,")"
+
+    store = open_store(tile_dir, name, bbox, minZoom, maxZoom)
+
+    gprj = GoogleProjection(maxZoom+1) 
+    # what a chunk holds depends on these, so a log of finished chunks
+    # only counts if they haven't changed
+    params = "bbox=%r chunk=%d metatile=%d prune_extents=%r prune_empty=%r" % (
+        tuple(bbox), CHUNK_SIZE, METATILE, bool(prune_extents), bool(prune_empty))
+    completed = store.completed(params)
+    extents = None
+    if prune_extents:
+        extents = data_extents(mapfile)
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, init_worker, (mapfile, maxZoom))
+    else:
+        pool = None
+        init_worker(mapfile, maxZoom)
+
+    # with prune_empty, the keys of the empty tiles rendered at each zoom
+    empty = {}
+
+    def run(todo):
+        if pool is not None:
+            results = pool.imap_unordered(render_chunk, todo)
+        else:
+            results = (render_chunk(c) for c in todo)
+
+        # one transaction per chunk
+        for chunk_id, z, tiles in results:
+            nempty = 0
+            for x, y, data in tiles:
+                store.put(z, x, y, data)
+                if len(data) == EMPTY_TILE_SIZE:
+                    nempty += 1
+                    if prune_empty:
+                        empty.setdefault(z, []).append((x << 32) | y)
+            store.mark_completed(chunk_id)
+            store.commit()
+            print name,"[",minZoom,"-",maxZoom,"]: chunk",chunk_id,len(tiles),"tiles,",nempty,"empty"
+
+    # Tiles are planned a strip at a time and rendered once enough are
+    # waiting, so nothing proportional to the whole pyramid is held.
+    # Levels below an empty tile are skipped without being rendered, so
+    # only the empty tiles that were stored need remembering; tiles pruned
+    # on extents have descendants that are pruned on extents too. Empty
+    # tiles come from what was rendered, and from the store only for the
+    # chunks an earlier run finished
+    empty_ancestors = []
+    skipped = None
+    todo = []
+    ntodo = 0
+    for z, x0, x1, y0, y1 in tile_ranges(gprj, bbox, minZoom, maxZoom):
+        if prune_empty and z > minZoom:
+            keys = empty.pop(z - 1, [])
+            if skipped:
+                stored = store.empty_tiles(z - 1, EMPTY_TILE_SIZE, skipped, CHUNK_SIZE)
+                keys.extend([(x << 32) | y for x, y in stored])
+            empty_ancestors.append((z - 1, numpy.unique(numpy.array(keys, numpy.int64))))
+        if prune_empty:
+            skipped = []
+        nchunks = pruned = 0
+        for xs, ys in level_tiles(x0, x1, y0, y1):
+            keep = prune_tiles(gprj, z, xs, ys, extents, empty_ancestors)
+            pruned += len(xs) - keep.sum()
+            for chunk in level_chunks(z, xs[keep], ys[keep], completed=completed, skipped=skipped):
+                todo.append(chunk)
+                ntodo += len(chunk[2])
+                nchunks += 1
+                if ntodo >= PLAN_TILES:
+                    run(todo)
+                    todo = []
+                    ntodo = 0
+        print name, "[",minZoom,"-",maxZoom,"]: zoom",z,nchunks,"chunks to render,",pruned,"tiles pruned"
+        # with prune_empty each zoom level waits for the one above it
+        if prune_empty:
+            run(todo)
+            todo = []
+            ntodo = 0
+    run(todo)
+    store.close()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 if __name__ == "__main__":
     home = os.environ['HOME']
@@ -111,6 +355,5 @@ if __name__ == "__main__":
     minZoom = 9
     maxZoom = 17
     bbox = (-119.945,34.375,-119.55,34.55)
-    render_tiles(bbox, mapfile, tile_dir, minZoom, maxZoom)
-     
-
+    render_tiles(bbox, mapfile, tile_dir, minZoom, maxZoom, processes=multiprocessing.cpu_count(),
+                 prune_extents=True)
@@ -21,7 +21,7 @@
 import sys
 import gdal
 from great_circle import greatCircle
-#from rasterQuery import getRasterValue
+from rasterQuery import RasterSampler
 from elevationClient import getNEDElevation
 try:
     from xml.etree.ElementTree import Element, ElementTree
@@ -47,7 +47,9 @@ def parseTrkpnts(gpx):
 
     return trkpnts
 
-def createProfile(trkpnts,raster="/home/perry/data/sbdata/sbdems/sbdems.tif",hunits="mi"):
+def createProfile(trkpnts,raster=None,hunits="mi",cache=None):
+    # Elevations come from the raster (e.g. "/home/perry/data/sbdata/sbdems/sbdems.tif")
+    # when one is given, otherwise from the NED web service
     elevs = []
     dists = []
     pnt1_lat = None 
@@ -66,9 +68,13 @@ def createProfile(trkpnts,raster="/home/perry/data/sbdata/sbdems/sbdems.tif",hun
             pnt2_lon = i['lon']
             dist = greatCircle(pnt1_lon,pnt1_lat,pnt2_lon,pnt2_lat,units="mi")
             cumdist = cumdist + dist
-#       elevs.append( getRasterValue(pnt2_lon,pnt2_lat,raster,window=1) )
-        elevs.append( getNEDElevation(pnt2_lon,pnt2_lat,"ft") )
+        if raster is None:
+            elevs.append( getNEDElevation(pnt2_lon,pnt2_lat,"ft") )
         dists.append(cumdist)
+    if raster is not None:
+        sampler = RasterSampler(raster, cache=cache)
+        values = sampler.sample([i['lon'] for i in trkpnts], [i['lat'] for i in trkpnts])
+        elevs = [None if v != v else v for v in values]
     profile = {'elevs':elevs, 'dists':dists}
     return profile
     
@@ -4,21 +4,41 @@ import sys
 import math
 import os.path
 import optparse
+import collections
+import multiprocessing
 import osgeo.gdal as gdal
-import PIL.Image
 import numpy
 
 NODATA = -1
 
+# rough peak bytes held per output pixel by hillshade(): the float32 input
+# plus a dozen float64 temporaries, and the extra for every light in
+# multi_hillshade()
+BYTES_PER_CELL = 128
+BYTES_PER_LIGHT = 24
+
+# streaming windows are at least this many rows tall before falling back
+# to square tiles, and snap to the output GeoTIFF tile size
+MIN_STRIP_ROWS = 16
+TILE_SIZE = 256
+
+# memory budget in MB when --jobs is given without --memory, the fewest
+# windows handed to each worker so the pool stays busy, and the most
+# windows per worker being shaded or waiting to be written at once
+DEFAULT_MEMORY = 1024
+WINDOWS_PER_JOB = 4
+IN_FLIGHT_PER_JOB = 2
+
 def arr2img(ar):
     """ Convert Numeric.array to PIL.Image.
     """
+    import PIL.Image
     return PIL.Image.fromstring('L', (ar.shape[1], ar.shape[0]), ar.astype('b').tostring())
 
-def hillshade(cell, xres, yres, nodata=None, azimuth=315.0, altitude=45.0, z=1.0, scale=1.0):
-    """ cell is an array of elevation values. return array will have outermost pixel edge removed.
-    
-        logic borrowed from hillshade.cpp, http://www.perrygeo.net/wordpress/?p=7
+def gradient(cell, xres, yres, z=1.0, scale=1.0):
+    """ cell is an array of elevation values. return the x and y slope components
+        and the 3x3 window of shifted views they were computed from; all have the
+        outermost pixel edge removed.
     """
     # print >> sys.stderr, 'making window...'
     
@@ -38,6 +58,15 @@ def hillshade(cell, xres, yres, nodata=None, azimuth=315.0, altitude=45.0, z=1.0
        - (z * window[0] + z * window[1] + z * window[1] + z * window[2])) \
       / (8.0 * yres * scale);
 
+    return x, y, window
+
+def hillshade(cell, xres, yres, nodata=None, azimuth=315.0, altitude=45.0, z=1.0, scale=1.0):
+    """ cell is an array of elevation values. return array will have outermost pixel edge removed.
+    
+        logic borrowed from hillshade.cpp, http://www.perrygeo.net/wordpress/?p=7
+    """
+    x, y, window = gradient(cell, xres, yres, z, scale)
+
     rad2deg = 180.0 / math.pi
     
     slope = 90.0 - numpy.arctan(numpy.sqrt(x*x + y*y)) * rad2deg
@@ -66,6 +95,60 @@ def hillshade(cell, xres, yres, nodata=None, azimuth=315.0, altitude=45.0, z=1.0
     
     return shaded
 
+def multi_hillshade(cell, xres, yres, lights, nodata=None, z=1.0, scale=1.0, stack=False):
+    """ Shade cell once for each (azimuth, altitude, weight) in lights.
+    
+        Slope and aspect come from a single pass over the window, so every extra
+        light only costs a few multiply-adds per pixel. Returns the weighted blend
+        of the shades, or with stack=True an array of one shade per light.
+    """
+    x, y, window = gradient(cell, xres, yres, z, scale)
+
+    rad2deg = 180.0 / math.pi
+    deg2rad = math.pi / 180.0
+    
+    slope = (90.0 - numpy.arctan(numpy.sqrt(x*x + y*y)) * rad2deg) * deg2rad
+    aspect = numpy.arctan2(x, y)
+    
+    sin_slope, cos_slope = numpy.sin(slope), numpy.cos(slope)
+    sin_aspect, cos_aspect = numpy.sin(aspect), numpy.cos(aspect)
+    
+    shades = []
+    
+    for azimuth, altitude, weight in lights:
+        # cos(a - aspect) expanded so the aspect terms are shared between lights
+        a = (azimuth - 90.0) * deg2rad
+        
+        shaded = math.sin(altitude * deg2rad) * sin_slope \
+               + math.cos(altitude * deg2rad) * cos_slope \
+               * (math.cos(a) * cos_aspect + math.sin(a) * sin_aspect)
+        
+        shades.append(shaded * 255)
+    
+    if stack:
+        shaded = numpy.array(shades)
+    else:
+        total = sum([weight for azimuth, altitude, weight in lights])
+        if total == 0:
+            raise ValueError('Light weights add up to zero, nothing to blend')
+        shaded = sum([shade * weight for shade, (azimuth, altitude, weight) in zip(shades, lights)]) / total
+    
+    if nodata is not None:
+        for pane in window:
+            shaded[..., pane == nodata] = NODATA
+
+    return shaded
+
+def parse_light(value):
+    """ Turn an 'azimuth,altitude[,weight]' string into a light tuple.
+    """
+    items = [float(v) for v in value.split(',')]
+    if len(items) == 2:
+        items.append(1.0)
+    if len(items) != 3:
+        raise ValueError('Expected azimuth,altitude[,weight], got "%s"' % value)
+    return tuple(items)
+
 def getbase(azimuth=315.0, altitude=45.0):
     """ Shade a flat piece of ground to determine what its color is
     """
@@ -73,6 +156,143 @@ def getbase(azimuth=315.0, altitude=45.0):
     shaded = hillshade(cell, 1, 1, None, azimuth, altitude).astype(numpy.ubyte)
     return shaded[0, 0]
 
+def windows(cols, rows, max_cells):
+    """ Split a cols x rows output grid into (xoff, yoff, xsize, ysize) windows
+        of at most max_cells pixels: full-width strips when enough rows fit,
+        square tiles otherwise. Sizes snap to multiples of TILE_SIZE if large enough.
+    """
+    max_cells = max(1, max_cells)
+    
+    if cols * MIN_STRIP_ROWS <= max_cells:
+        xsize, ysize = cols, max_cells / cols
+    else:
+        xsize = ysize = max(1, int(math.sqrt(max_cells)))
+        if xsize >= TILE_SIZE:
+            xsize = ysize = xsize - xsize % TILE_SIZE
+
+    if ysize >= TILE_SIZE:
+        ysize -= ysize % TILE_SIZE
+    
+    for yoff in range(0, rows, ysize):
+        for xoff in range(0, cols, xsize):
+            yield xoff, yoff, min(xsize, cols - xoff), min(ysize, rows - yoff)
+
+def shade_window(band, xoff, yoff, xsize, ysize, xres, yres, nodata=None, azimuth=315.0, altitude=45.0, lights=None, stack=False):
+    """ Shade one window of the output grid, reading it from band with a one-pixel halo.
+    
+        Output pixel (x, y) lines up with input pixel (x + 1, y + 1), so adjacent
+        windows share their halo and meet without seams. Given lights, azimuth and
+        altitude are ignored and the window goes through multi_hillshade().
+    """
+    data = band.ReadRaster(xoff, yoff, xsize + 2, ysize + 2, buf_type=gdal.GDT_Float32)
+    cell = numpy.fromstring(data, dtype=numpy.float32).reshape(ysize + 2, xsize + 2)
+    if lights:
+        return multi_hillshade(cell, xres, yres, lights, nodata, stack=stack)
+    return hillshade(cell, xres, yres, nodata, azimuth, altitude)
+
+def create_output(dem, output, options=[], bands=1):
+    """ Create the Int16 GeoTIFF for a shaded dem, one pixel of choke smaller on every side.
+    """
+    driver = gdal.GetDriverByName('GTiff')
+    
+    demtx = list(dem.GetGeoTransform())
+    
+    # account for a pixel of choke
+    demtx[0], demtx[3] = demtx[0] + demtx[1], demtx[3] + demtx[5]
+    
+    tif = driver.Create(output, dem.RasterXSize - 2, dem.RasterYSize - 2, bands, gdal.GDT_Int16, options)
+    tif.SetGeoTransform(demtx)
+    tif.SetProjection(dem.GetProjection())
+    
+    for i in range(bands):
+        tif.GetRasterBand(i + 1).SetNoDataValue(NODATA)
+    
+    return tif
+
+def write_window(tif, xoff, yoff, shaded):
+    """ Write a shaded array into the output at xoff, yoff, one band per
+        layer if it is a stack.
+    """
+    if shaded.ndim == 2:
+        shaded = shaded[numpy.newaxis]
+    
+    for i, layer in enumerate(shaded):
+        tifdata = layer.astype(numpy.int16).tostring()
+        tif.GetRasterBand(i + 1).WriteRaster(xoff, yoff, layer.shape[1], layer.shape[0], tifdata, buf_type=gdal.GDT_Int16)
+
+# per-process state for the worker pool, filled in by _init_worker()
+_worker = {}
+
+def _init_worker(input, xres, yres, nodata, azimuth, altitude, lights, stack):
+    """ Open a GDAL handle on the DEM once in each pool process.
+    """
+    _worker['dem'] = gdal.Open(input)
+    _worker['band'] = _worker['dem'].GetRasterBand(1)
+    _worker['args'] = (xres, yres, nodata, azimuth, altitude, lights, stack)
+
+def _shade_task(window):
+    """ Shade one (xoff, yoff, xsize, ysize) window inside a pool process.
+    """
+    xoff, yoff, xsize, ysize = window
+    shaded = shade_window(_worker['band'], xoff, yoff, xsize, ysize, *_worker['args'])
+    return window, shaded.astype(numpy.int16)
+
+def hillshade_streaming(dem, output, max_memory, azimuth=315.0, altitude=45.0, jobs=1, lights=None, stack=False):
+    """ Shade dem into a GeoTIFF at output one window at a time.
+    
+        Windows are sized so hillshade() temporaries stay within max_memory bytes,
+        whatever the size of the raster. With jobs > 1 the budget is split across
+        a pool of processes, each with its own handle on the DEM, and windows are
+        written back in the same order as the serial path. Given lights, each
+        window is shaded with multi_hillshade() and a stack gets one band per light.
+    """
+    band = dem.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    
+    tx = dem.GetGeoTransform()
+    assert tx[2] == 0 and tx[4] == 0
+    
+    xres, yres = tx[1], tx[5]
+    
+    bands = 1
+    cell_bytes = BYTES_PER_CELL
+    
+    if lights:
+        cell_bytes += BYTES_PER_LIGHT * len(lights)
+        if stack:
+            bands = len(lights)
+    
+    tif = create_output(dem, output, ['TILED=YES', 'BIGTIFF=IF_SAFER'], bands)
+    
+    cols, rows = tif.RasterXSize, tif.RasterYSize
+    
+    if jobs > 1:
+        max_cells = min(max_memory / jobs / cell_bytes, cols * rows / (jobs * WINDOWS_PER_JOB))
+        pool = multiprocessing.Pool(jobs, _init_worker, (dem.GetDescription(), xres, yres, nodata, azimuth, altitude, lights, stack))
+        
+        # pool.imap() would queue up every finished window while the writes
+        # lag behind, so only hand out a few windows more than are written
+        pending = collections.deque()
+        for window in windows(cols, rows, max_cells):
+            if len(pending) >= jobs * IN_FLIGHT_PER_JOB:
+                (xoff, yoff, xsize, ysize), shaded = pending.popleft().get()
+                write_window(tif, xoff, yoff, shaded)
+            pending.append(pool.apply_async(_shade_task, (window, )))
+        
+        while pending:
+            (xoff, yoff, xsize, ysize), shaded = pending.popleft().get()
+            write_window(tif, xoff, yoff, shaded)
+        
+        pool.close()
+        pool.join()
+    
+    else:
+        for xoff, yoff, xsize, ysize in windows(cols, rows, max_memory / cell_bytes):
+            shaded = shade_window(band, xoff, yoff, xsize, ysize, xres, yres, nodata, azimuth, altitude, lights, stack)
+            write_window(tif, xoff, yoff, shaded)
+    
+    tif = None
+
 if __name__ == '__main__':
 
     parser = optparse.OptionParser('usage: ...')
@@ -83,10 +303,31 @@ if __name__ == '__main__':
     parser.add_option('-o', '--output', dest='output',
                       help='Output file')
 
+    parser.add_option('-m', '--memory', dest='memory', type='int',
+                      help='Stream the DEM through windows using at most this many MB, skips out.jpg')
+
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+                      help='Shade windows in this many processes, implies --memory %d' % DEFAULT_MEMORY)
+
+    parser.add_option('-l', '--light', dest='lights', action='append', type='string',
+                      help='Light source as azimuth,altitude[,weight], repeat for a multidirectional hillshade')
+
+    parser.add_option('-s', '--stack', dest='stack', action='store_true', default=False,
+                      help='Write one band per --light instead of their weighted blend')
+
     (options, args) = parser.parse_args()
     
     input, output = options.input, options.output
     
+    lights = None
+    if options.lights:
+        try:
+            lights = [parse_light(light) for light in options.lights]
+        except ValueError, e:
+            parser.error(str(e))
+        if not options.stack and sum([weight for azimuth, altitude, weight in lights]) == 0:
+            parser.error('--light weights add up to zero, nothing to blend')
+    
     dem = gdal.Open(input)
     band = dem.GetRasterBand(1)
     cols, rows = dem.RasterXSize, dem.RasterYSize
@@ -94,6 +335,14 @@ if __name__ == '__main__':
     print cols, 'x', rows,
     print 'floor', getbase()
     
+    if options.memory or options.jobs > 1:
+        print >> sys.stderr, 'streaming shaded hills...'
+        
+        memory = options.memory or DEFAULT_MEMORY
+        hillshade_streaming(dem, output, memory * 1024 * 1024, jobs=options.jobs,
+                            lights=lights, stack=options.stack)
+        sys.exit(0)
+    
     print >> sys.stderr, 'extracting data...'
     
     data = band.ReadRaster(0, 0, cols, rows, buf_type=gdal.GDT_Float32)
@@ -106,34 +355,24 @@ if __name__ == '__main__':
     
     xres, yres = tx[1], tx[5]
     
-    shaded = hillshade(cell, xres, yres, band.GetNoDataValue())
+    if lights:
+        shaded = multi_hillshade(cell, xres, yres, lights, band.GetNoDataValue(), stack=options.stack)
+    else:
+        shaded = hillshade(cell, xres, yres, band.GetNoDataValue())
     
     ## this part is unfortunate, wish it wasn't necessary, seems broken
     #shaded[shaded == NODATA] = getbase()
     
     print >> sys.stderr, 'compositing image...'
     
-    print >> sys.stderr, 'saving jpeg...'
-    
-    out = numpy.clip(shaded, 0x00, 0xFF).astype(numpy.ubyte)
-    jpg = arr2img(out)
-    jpg.save('out.jpg')
+    if shaded.ndim == 2:
+        print >> sys.stderr, 'saving jpeg...'
+        
+        out = numpy.clip(shaded, 0x00, 0xFF).astype(numpy.ubyte)
+        jpg = arr2img(out)
+        jpg.save('out.jpg')
     
     print >> sys.stderr, 'saving geotiff...'
     
-    driver = gdal.GetDriverByName('GTiff')
-    
-    demtx = list(dem.GetGeoTransform())
-    
-    # account for a pixel of choke
-    demtx[0], demtx[3] = demtx[0] + demtx[1], demtx[3] + demtx[5]
-    
-    tif = driver.Create(output, shaded.shape[1], shaded.shape[0], 1, gdal.GDT_Int16)
-    tif.SetGeoTransform(demtx)
-    tif.SetProjection(dem.GetProjection())
-    
-    tifband = tif.GetRasterBand(1)
-    tifband.SetNoDataValue(NODATA)
-    
-    tifdata = shaded.astype(numpy.int16).tostring()
-    tifband.WriteRaster(0, 0, tif.RasterXSize, tif.RasterYSize, tifdata, buf_type=gdal.GDT_Int16)
+    tif = create_output(dem, output, bands=len(shaded) if shaded.ndim == 3 else 1)
+    write_window(tif, 0, 0, shaded)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+ hillshade_bench.py
+ Time the serial and multi-process paths of hillshade.py on a synthetic DEM
+ and check that both write identical output.
+
+    python hillshade_bench.py [size] [jobs]
+"""
+import os
+import sys
+import math
+import time
+import shutil
+import tempfile
+import multiprocessing
+import numpy
+from osgeo import gdal
+from hillshade import hillshade_streaming, DEFAULT_MEMORY
+
+def synthetic_dem(path, size, cellsize=30.0):
+    """ Write a size x size GeoTIFF of rolling hills, a strip at a time.
+    """
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(path, size, size, 1, gdal.GDT_Float32, ['TILED=YES'])
+    ds.SetGeoTransform([0, cellsize, 0, size * cellsize, 0, -cellsize])
+    band = ds.GetRasterBand(1)
+
+    x = numpy.linspace(0, 12 * math.pi, size)
+    for yoff in range(0, size, 256):
+        y = numpy.linspace(0, 12 * math.pi, size)[yoff:yoff + 256, numpy.newaxis]
+        hills = 800 * numpy.sin(x) * numpy.cos(y) + 150 * numpy.sin(3.7 * x + y)
+        band.WriteArray(hills.astype(numpy.float32), 0, yoff)
+
+    band = None
+    ds = None
+
+def same_raster(path1, path2):
+    """ Compare the first band of two rasters strip by strip.
+    """
+    band1 = gdal.Open(path1).GetRasterBand(1)
+    band2 = gdal.Open(path2).GetRasterBand(1)
+    if (band1.XSize, band1.YSize) != (band2.XSize, band2.YSize):
+        return False
+    for yoff in range(0, band1.YSize, 256):
+        rows = min(256, band1.YSize - yoff)
+        if band1.ReadRaster(0, yoff, band1.XSize, rows) != band2.ReadRaster(0, yoff, band2.XSize, rows):
+            return False
+    return True
+
+def timed(dem, output, jobs):
+    start = time.time()
+    hillshade_streaming(gdal.Open(dem), output, DEFAULT_MEMORY * 1024 * 1024, jobs=jobs)
+    return time.time() - start
+
+if __name__ == '__main__':
+    size = 8192
+    jobs = multiprocessing.cpu_count()
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        jobs = int(sys.argv[2])
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        dem = os.path.join(tmpdir, 'dem.tif')
+        print 'building %d x %d synthetic dem...' % (size, size)
+        synthetic_dem(dem, size)
+
+        serial = timed(dem, os.path.join(tmpdir, 'serial.tif'), 1)
+        print 'serial:   %.2f s' % serial
+
+        parallel = timed(dem, os.path.join(tmpdir, 'parallel.tif'), jobs)
+        print '%d jobs: %.2f s (%.1fx speedup)' % (jobs, parallel, serial / parallel)
+
+        if same_raster(os.path.join(tmpdir, 'serial.tif'), os.path.join(tmpdir, 'parallel.tif')):
+            print 'outputs match'
+        else:
+            print 'OUTPUTS DIFFER'
+            sys.exit(1)
+    finally:
+        shutil.rmtree(tmpdir)
@@ -1,101 +1,224 @@
 # ogr_catalog5.py
 # Purpose: Catalog all vector datasources/layers found in a directory tree
-# Usage: python ogr_catalog4.py <path> <output prefix> <header comment char>
+# Usage: python ogr_catalog4.py [-threads n] [-manifest file] [-db file.sqlite]
+#          <path> <output prefix> <header comment char>
 # Creates prefix_ds.txt, prefix_lay.txt in | pipe delimited format
+# What was found in each file is kept in prefix_manifest.json so that
+#  re-runs only open files whose time or size changed
+# With -db the layers also go into a SQLite database with an R-tree on
+#  their extents (see catalog_db.py)
 # Author: Tyler Mitchell, Jan-2006
 
-import gdal, ogr, os, sys
+import gdal, ogr, osr, os, sys, struct
+from multiprocessing.pool import ThreadPool
+from catalog_manifest import Manifest, MISSING, file_key
+from catalog_db import CatalogDB
 
-def walkall(walkloc,dsfileout,layfileout):
+# Set which file extensions will be ignored as datasources
+skipext = ('dbf','shx', 'xsd', 'tif', 'jpg', 'e00')
+
+# Files opened at once
+THREADS = 8
+
+# Layout of the records kept in the manifest
+MANIFEST_VERSION = 3
+
+def walkall(walkloc,dsfileout,layfileout,headercmt='',manifest=None,threads=THREADS,db=None,root=None):
   # The following counters will be used for generating
   #  unique datasource and layer ids (i.e. primary keys)
   dscounter = 0
   layercounter = 0
-  
-  # Check if the user wants to comment the first/header line in the output
-  # If so, use the character given in the 3rd argument
-  if len(sys.argv) > 3:
-    headercmt = sys.argv[3]
-  else:
-    headercmt = ''
+  if manifest is None:
+    manifest = Manifest(version=MANIFEST_VERSION)
 
   # Open up the output files
   dsfileout.write(''.join([headercmt,'dsid|datasource|format|layercount\n']))
   layfileout.write(''.join([headercmt,'layerid|dsid|datasource|format|layernumber|layername|featurecount|extent\n']))
 
-  # Start walking through all the folders in specified path
+  def lookup(filepath):
+    key = file_key(filepath)
+    record = manifest.get(filepath,key)
+    if record is MISSING:
+      record = scanpath(filepath)
+      manifest.put(filepath,record,key)
+    return filepath, record
+
+  # Layers stored this scan; with root given, others under it are
+  #  dropped from the db afterwards
+  seen = set()
+
+  # Datasources are read in the pool but written out in walk order
+  pool = ThreadPool(threads,quieterrors)
+  for filepath, record in pool.imap(lookup,candidates(walkloc),16):
+    if record is None:
+      continue
+    print ' '.join(['-CATALOGUING:',filepath])
+    dscounter += 1
+    dsstring = '|'.join([record['name'],record['format']])
+    dsfileout.write('|'.join([str(dscounter),dsstring,str(len(record['layers']))]))
+    dsfileout.write('\n')
+    for laynum, layername, layerfcount, layerextent, layersrs in record['layers']:
+      layercounter += 1
+      details = "|".join( [dsstring,str(laynum),layername,str(layerfcount),str(tuple(layerextent))] )
+      layfileout.write('|'.join([str(layercounter),str(dscounter),details]))
+      layfileout.write('\n')
+      if db is not None:
+        db.add_layer(record['name'],record['format'],laynum,layername,layerfcount,layersrs,layerextent)
+        seen.add((record['name'],laynum))
+  pool.close()
+  pool.join()
+  if db is not None and root is not None:
+    gone = db.remove_missing_layers(root,seen)
+    if gone:
+      print "*Removed",gone,"layers no longer found under",root
+
+def candidates(walkloc):
+  # Each folder's subdirectories, then its files
   for walkdirs in walkloc:
     topdir = walkdirs[0]
     dirs = walkdirs[1]
     files = walkdirs[2]
     for walkdir in dirs:
-      currentpath = os.path.join(topdir,walkdir)
-      if (checkds(currentpath)):
-        ds = ogr.OpenShared(currentpath)
-        dscounter += 1
-        try:
-          dsdetails, dslcount = getdsdetails(currentpath, ds)
-        except:
-          print "** unable to get dataset details for", currentpath
-
-        dsfileout.write('|'.join([str(dscounter),str(dsdetails),str(dslcount)]))
-        dsfileout.write('\n')
-        for laynum in range(dslcount):
-          layercounter += 1
-          layfileout.write('|'.join([str(layercounter),str(dscounter),str(getlayerdetails(currentpath,laynum,ds))]))
-          layfileout.write('\n')
-      for walkfile in files:
-        currentfile = os.path.join(currentpath,walkfile)
-        if (checkds(currentfile)):
-          layercounter += 1
-          layfileout.write('|'.join([str(layercounter),str(dscounter),str(getlayerdetails(currentfile,laynum,ds))]))
-          layfileout.write('\n')
-
-def checkds(filepath):
+      yield os.path.join(topdir,walkdir)
+    for walkfile in files:
+      if (walkfile[-3:] not in skipext):
+        yield os.path.join(topdir,walkfile)
+
+def quieterrors():
+  # GDAL error handlers are per thread
+  gdal.PushErrorHandler('CPLQuietErrorHandler')
+
+def scanpath(filepath):
+  """
+  Collect the datasource and layer details for filepath, opening it once.
+  Returns None if it isn't a vector datasource.
+  """
   try:
-    ds = ogr.OpenShared(filepath)
-    return True
-  except ogr.OGRError:
-    return False
+    record = shapefiledetails(filepath)
+    if record is not None:
+      return record
+
+    ds = ogr.Open(filepath)
+    if ds is None:
+      return None
+    dsname, dsformat, dslcount = getdsdetails(filepath,ds)
+    # A folder of shapefiles opens as one datasource, but the
+    #  shapefiles are already catalogued one by one
+    if os.path.isdir(filepath) and dsformat == 'ESRI Shapefile':
+      return None
+    layers = [getlayerdetails(ds,laynum) for laynum in range(dslcount)]
+    return {'name': dsname, 'format': dsformat, 'layers': layers}
+  except Exception, e:
+    print "** unable to get dataset details for", filepath, e
+    return None
+
+def shapefiledetails(filepath):
+  """
+  Read a shapefile's extent from the .shp header and its feature count
+  from the size of the .shx index, without going through OGR
+  """
+  base, ext = os.path.splitext(filepath)
+  if ext.lower() != '.shp':
+    return None
+  for shxext in ('.shx', '.SHX'):
+    if os.path.exists(base + shxext):
+      break
+  else:
+    return None
+
+  fh = open(filepath, 'rb')
+  header = fh.read(100)
+  fh.close()
+  if len(header) < 100 or struct.unpack('>i', header[:4])[0] != 9994:
+    return None
+  xmin, ymin, xmax, ymax = struct.unpack('<4d', header[36:68])
+  featurecount = (os.path.getsize(base + shxext) - 100) / 8
+
+  srs = ''
+  for prjext in ('.prj', '.PRJ'):
+    if os.path.exists(base + prjext):
+      srs = prjwkt(open(base + prjext).read())
+      break
+
+  # Same order as OGR's GetExtent()
+  extent = [xmin, xmax, ymin, ymax]
+  layer = [0, os.path.basename(base), featurecount, extent, srs]
+  return {'name': filepath, 'format': 'ESRI Shapefile', 'layers': [layer]}
+
+def prjwkt(prj):
+  """
+  Turn .prj text (ESRI WKT) into the WKT OGR reports for the layer, so a
+  shapefile's srs matches other datasources in the same CRS. Returns ''
+  if the text can't be read, as OGR then gives the layer no SRS
+  """
+  srs = osr.SpatialReference()
+  if srs.ImportFromESRI([prj.strip()]) != 0:
+    return ''
+  # As OGR's shapefile driver does
+  srs.AutoIdentifyEPSG()
+  return srs.ExportToWkt()
 
 def getdsdetails(filepath,ds):
-  print ' '.join(['-SEARCHING:',filepath])
-  if (filepath[-3:] not in skipext):
-    #ds = ogr.OpenShared(filepath)
-    dsname = ds.GetName()
-    dsformat = ds.GetDriver().GetName()
-    dslcount = ds.GetLayerCount()
-    dsstring = '|'.join([dsname, dsformat])
-    return dsstring, dslcount
-
-def getlayerdetails(filepath,laynum,ds):
-  if (filepath[-3:] not in skipext):
-    #ds = ogr.OpenShared(filepath)
-    dsstring, dslcount = getdsdetails(ds.GetName(),ds)
-    details = ''
-    layer = ds.GetLayer(laynum)
-    layername = layer.GetName()
-    print ' '.join(['--PROCESSING LAYER:',str(laynum),layername])
-    layerfcount = str(layer.GetFeatureCount())
-    layerextent = str(layer.GetExtent())
-    details = "|".join( [dsstring,str(laynum),layername,layerfcount,str(layerextent)] )
-    return details
+  dsname = ds.GetName()
+  dsformat = ds.GetDriver().GetName()
+  dslcount = ds.GetLayerCount()
+  return dsname, dsformat, dslcount
+
+def getlayerdetails(ds,laynum):
+  layer = ds.GetLayer(laynum)
+  layername = layer.GetName()
+  layerfcount = layer.GetFeatureCount()
+  layerextent = list(layer.GetExtent())
+  layersrs = ''
+  if layer.GetSpatialRef() is not None:
+    layersrs = layer.GetSpatialRef().ExportToWkt()
+  return [laynum, layername, layerfcount, layerextent, layersrs]
 
 if __name__ == '__main__':
   # This disables error messages to stdout when a datasource can't
   #  be opened
   gdal.PushErrorHandler()
 
-  # Set which file extensions will be ignored as datasources  
-  skipext = ('dbf','shx', 'xsd', 'tif', 'jpg', 'e00')
+  threads = THREADS
+  manifestfile = None
+  dbfile = None
+  args = []
+  i = 1
+  while i < len(sys.argv):
+    arg = sys.argv[i]
+    if arg == '-threads':
+      i = i + 1
+      threads = int(sys.argv[i])
+    elif arg == '-manifest':
+      i = i + 1
+      manifestfile = sys.argv[i]
+    elif arg == '-db':
+      i = i + 1
+      dbfile = sys.argv[i]
+    else:
+      args.append(arg)
+    i = i + 1
+
+  # Check if the user wants to comment the first/header line in the output
+  # If so, use the character given in the 3rd argument
+  if len(args) > 2:
+    headercmt = args[2]
+  else:
+    headercmt = ''
 
   # Set up the output file that will be created
-  prefix = sys.argv[2]
+  prefix = args[1]
   dstxt = '_'.join([prefix,'ds.txt'])
   laytxt = '_'.join([prefix,'lay.txt'])
+  if manifestfile is None:
+    manifestfile = '_'.join([prefix,'manifest.json'])
   print ' '.join(['*Opening output files:',dstxt,laytxt])
   dsfileout = open(dstxt, 'w')
   layfileout = open(laytxt, 'w')
+  manifest = Manifest(manifestfile,MANIFEST_VERSION)
+  db = None
+  if dbfile is not None:
+    db = CatalogDB(dbfile)
 
   # Below, walkloc holds a list of a string and two arrays:
   #   walkloc.next[0] - top level "current" walk dir (string)
@@ -104,8 +227,11 @@ if __name__ == '__main__':
   #   walkloc.next cycles through every folder in [1]
   # Top dir comes from 1st command line argument
   #walkloc = os.walk('c:/temp/geobase') # for testing
-  walkloc = os.walk(sys.argv[1])
-  walkall(walkloc,dsfileout,layfileout)
+  walkloc = os.walk(args[0])
+  walkall(walkloc,dsfileout,layfileout,headercmt,manifest,threads,db,args[0])
+  manifest.save()
+  if db is not None:
+    db.close()
 
   #cleanup
   print ' '.join(['*Closing output files:',dstxt,laytxt])
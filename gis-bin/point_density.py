@@ -15,9 +15,12 @@
 """
 import ogr
 import sys
-import Numeric
+import numpy
 import gdal
 
+# Points read from the layer before binning them into the grid
+BATCH_SIZE = 1000000
+
 def getOpts():
     poly_ds = "/home/perry/data/world_cities/cities.shp"
     poly_lyr = 0
@@ -25,41 +28,81 @@ def getOpts():
     cellsize = 1 
     outfile = "/home/perry/Desktop/test2.tif"
     format = "GTiff"
-    return (poly_ds,poly_lyr,extent,cellsize,outfile,format)    
-   
-if __name__ == "__main__":
-    # Get the inputs
-    (poly_ds,poly_lyr,extent,cellsize,outfile,format) = getOpts()    
+    binning = True
+    return (poly_ds,poly_lyr,extent,cellsize,outfile,format,binning)    
 
-    # Get the input layer
-    ds = ogr.Open(poly_ds)
-    lyr = ds.GetLayer(poly_lyr)
-    
-    # TODO: Confirm dataset is point and extents overlap 
+def read_points(lyr, batch_size=BATCH_SIZE):
+    """
+    Yield (xs, ys) arrays of the layer's point coordinates, batch_size
+    points at a time
+    """
+    xs = []
+    ys = []
+    feat = lyr.GetNextFeature()
+    while feat is not None:
+        geom = feat.GetGeometryRef()
+        if geom is not None:
+            xs.append(geom.GetX())
+            ys.append(geom.GetY())
+        if len(xs) == batch_size:
+            yield numpy.array(xs), numpy.array(ys)
+            xs = []
+            ys = []
+        feat = lyr.GetNextFeature()
+    if xs:
+        yield numpy.array(xs), numpy.array(ys)
 
-    ydist = extent[3] - extent[1]
-    xdist = extent[2] - extent[0]
-    xcount = int(xdist/cellsize)
-    ycount = int(ydist/cellsize)
+def bin_points(xs, ys, extent, cellsize, density):
+    """
+    Add the points falling in each cell to the (ycount, xcount) array of
+    counts density. Only the cells holding points are touched, so the cost
+    follows the number of points, not the size of the grid
 
-    # Create output raster  
-    driver = gdal.GetDriverByName( format )
-    dst_ds = driver.Create( outfile, xcount, ycount, 1, gdal.GDT_Float32 )
+    A point exactly on the edge between cells is counted in both, as
+    the per-cell spatial filter does
+    """
+    ycount, xcount = density.shape
+    fx = (xs - extent[0]) / cellsize
+    fy = (extent[3] - ys) / cellsize
+    col = numpy.floor(fx).astype(numpy.int64)
+    row = numpy.floor(fy).astype(numpy.int64)
 
-    # the GT(2) and GT(4) coefficients are zero,     
-    # and the GT(1) is pixel width, and GT(5) is pixel height.     
-    # The (GT(0),GT(3)) position is the top left corner of the top left pixel
-    gt = (extent[0],cellsize,0,extent[3],0,(cellsize*-1.))
-    dst_ds.SetGeoTransform(gt)
-    
-    dst_band = dst_ds.GetRasterBand(1)
-    dst_band.SetNoDataValue( -9999 )
+    # Each point's own cell, then the cell across the edge it sits on
+    cols = [(col, numpy.ones(col.shape, dtype=bool)), (col - 1, fx == col)]
+    rows = [(row, numpy.ones(row.shape, dtype=bool)), (row - 1, fy == row)]
 
+    cells = []
+    for c, on_col in cols:
+        for r, on_row in rows:
+            keep = on_col & on_row & (c >= 0) & (c < xcount) & (r >= 0) & (r < ycount)
+            cells.append(r[keep] * xcount + c[keep])
+    # add.at counts repeated cells once per point, unlike density.flat[cells] += 1
+    numpy.add.at(density.reshape(-1), numpy.concatenate(cells), 1)
+
+def density_by_binning(lyr, extent, cellsize, xcount, ycount, dst_band):
+    """
+    Read every point once and bin it into the grid
+    """
+    lyr.SetSpatialFilterRect(extent[0], extent[3] - ycount * cellsize,
+                             extent[0] + xcount * cellsize, extent[3])
+    density = numpy.zeros((ycount, xcount), dtype=numpy.int64)
+    numpoints = 0
+    for xs, ys in read_points(lyr):
+        bin_points(xs, ys, extent, cellsize, density)
+        numpoints += len(xs)
+        print '%d points binned' % numpoints
+    lyr.SetSpatialFilter(None)
+    dst_band.WriteArray(density.astype(numpy.float32), 0, 0)
+
+def density_by_filter(lyr, extent, cellsize, xcount, ycount, dst_band):
+    """
+    Count the points in each cell with its own spatial filter query
+    """
     pixelnum = 0
     
     for ypos in range(ycount):
         # Create output line array
-        outArray = Numeric.zeros( (1, xcount) )
+        outArray = numpy.zeros( (1, xcount) )
         for xpos in range(xcount):
             # create a 4-item list of extents 
             minx = xpos * cellsize + extent[0] 
@@ -86,11 +129,44 @@ if __name__ == "__main__":
             # (ie loop through features
             # and ensure that the select features
             # actually intersect the cell geometry g)
-            Numeric.put( outArray, xpos, numfeatures )
+            outArray[0, xpos] = numfeatures
             lyr.ResetReading()
 
             pixelnum += 1
  
         print '%.2f pct complete' % (float(pixelnum)/(xcount*ycount) * 100.)
         dst_band.WriteArray(outArray,0,ypos)
+   
+if __name__ == "__main__":
+    # Get the inputs
+    (poly_ds,poly_lyr,extent,cellsize,outfile,format,binning) = getOpts()    
+
+    # Get the input layer
+    ds = ogr.Open(poly_ds)
+    lyr = ds.GetLayer(poly_lyr)
+    
+    # TODO: Confirm dataset is point and extents overlap 
+
+    ydist = extent[3] - extent[1]
+    xdist = extent[2] - extent[0]
+    xcount = int(xdist/cellsize)
+    ycount = int(ydist/cellsize)
+
+    # Create output raster  
+    driver = gdal.GetDriverByName( format )
+    dst_ds = driver.Create( outfile, xcount, ycount, 1, gdal.GDT_Float32 )
+
+    # the GT(2) and GT(4) coefficients are zero,     
+    # and the GT(1) is pixel width, and GT(5) is pixel height.     
+    # The (GT(0),GT(3)) position is the top left corner of the top left pixel
+    gt = (extent[0],cellsize,0,extent[3],0,(cellsize*-1.))
+    dst_ds.SetGeoTransform(gt)
+    
+    dst_band = dst_ds.GetRasterBand(1)
+    dst_band.SetNoDataValue( -9999 )
+
+    if binning:
+        density_by_binning(lyr, extent, cellsize, xcount, ycount, dst_band)
+    else:
+        density_by_filter(lyr, extent, cellsize, xcount, ycount, dst_band)
 
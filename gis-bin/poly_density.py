@@ -14,9 +14,16 @@
 """
 import ogr
 import sys
-import Numeric
+import numpy
 import gdal
 
+# Scanlines sampled through each row of cells. Coverage is exact along each
+# scanline and averaged across them, so this sets the vertical precision
+SUBROWS = 16
+
+# Scanline x polygon edge tests evaluated at once
+CHUNK_SIZE = 1048576
+
 def getOpts():
     poly_ds = "/home/perry/data/freegis_worlddata/geodata/countries_simpl.shp"
     poly_lyr = 0
@@ -24,41 +31,144 @@ def getOpts():
     cellsize = 1 
     outfile = "/home/perry/Desktop/test.tif"
     format = "GTiff"
-    return (poly_ds,poly_lyr,extent,cellsize,outfile,format)    
-   
-if __name__ == "__main__":
-    # Get the inputs
-    (poly_ds,poly_lyr,extent,cellsize,outfile,format) = getOpts()    
-
-    # Get the input layer
-    ds = ogr.Open(poly_ds)
-    lyr = ds.GetLayer(poly_lyr)
-    
-    # TODO: Confirm dataset is polygon and extents overlap 
-
-    ydist = extent[3] - extent[1]
-    xdist = extent[2] - extent[0]
-    xcount = int((xdist/cellsize)+1)
-    ycount = int((ydist/cellsize)+1)
-
-    # Create output raster  
-    driver = gdal.GetDriverByName( format )
-    dst_ds = driver.Create( outfile, xcount, ycount, 1, gdal.GDT_Float32 )
-
-    # the GT(2) and GT(4) coefficients are zero,     
-    # and the GT(1) is pixel width, and GT(5) is pixel height.     
-    # The (GT(0),GT(3)) position is the top left corner of the top left pixel
-    gt = (extent[0],cellsize,0,extent[3],0,(cellsize*-1.))
-    dst_ds.SetGeoTransform(gt)
-    
-    dst_band = dst_ds.GetRasterBand(1)
-    dst_band.SetNoDataValue( -9999 )
-
+    scanline = True
+    return (poly_ds,poly_lyr,extent,cellsize,outfile,format,scanline)    
+
+def polygon_edges(geom):
+    """
+    Collect the edges of every ring in a (multi)polygon geometry
+
+    Returns arrays x0, y0, x1, y1 with one entry per edge
+    """
+    rings = []
+    def walk(g):
+        if g.GetGeometryCount() > 0:
+            for i in range(g.GetGeometryCount()):
+                walk(g.GetGeometryRef(i))
+        else:
+            pts = g.GetPoints()
+            if pts and len(pts) > 1:
+                rings.append(numpy.array(pts)[:, :2])
+    walk(geom)
+
+    starts = []
+    ends = []
+    for ring in rings:
+        # close the ring if it isn't already
+        closed = numpy.vstack([ring, ring[:1]])
+        if (ring[0] == ring[-1]).all():
+            closed = ring
+        starts.append(closed[:-1])
+        ends.append(closed[1:])
+    if not starts:
+        return None
+    starts = numpy.vstack(starts)
+    ends = numpy.vstack(ends)
+    return starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1]
+
+def add_spans(cover, full, rows, a, b):
+    """
+    Add scanline spans [a, b), in units of cell widths, to the row's cells
+
+    Partly covered end cells go into cover, runs of fully covered cells are
+    marked as +1/-1 steps in full, to be summed along the row later
+    """
+    xcount = cover.shape[1]
+    ca = numpy.floor(a).astype(numpy.int64)
+    cb = numpy.floor(b).astype(numpy.int64)
+
+    same = ca == cb
+    numpy.add.at(cover, (rows[same], ca[same]), b[same] - a[same])
+
+    rows, a, b, ca, cb = rows[~same], a[~same], b[~same], ca[~same], cb[~same]
+    numpy.add.at(cover, (rows, ca), (ca + 1) - a)
+    inside = cb < xcount
+    numpy.add.at(cover, (rows[inside], cb[inside]), b[inside] - cb[inside])
+    numpy.add.at(full, (rows, ca + 1), 1)
+    numpy.add.at(full, (rows, cb), -1)
+
+def add_coverage(cover, full, edges, extent, cellsize, subrows=SUBROWS):
+    """
+    Add the covered fraction of each cell, times subrows, for one polygon
+
+    Scanlines run through the middle of subrows slices of every row the
+    polygon spans. Along each scanline the even-odd crossings of all ring
+    edges give the covered spans, which handles holes and multipolygons
+    """
+    ycount, xcount = cover.shape
+    x0, y0, x1, y1 = edges
+
+    first = max(0, int(numpy.floor((extent[3] - max(y0.max(), y1.max())) / cellsize)))
+    last = min(ycount - 1, int(numpy.floor((extent[3] - min(y0.min(), y1.min())) / cellsize)))
+    if first > last:
+        return
+
+    offsets = (numpy.arange(subrows) + 0.5) / subrows
+    lines = numpy.repeat(numpy.arange(first, last + 1), subrows)
+    ys = extent[3] - (lines + numpy.tile(offsets, last - first + 1)) * cellsize
+
+    dy = y1 - y0
+    dy[dy == 0] = 1.0
+    step = max(1, CHUNK_SIZE / len(x0))
+
+    for i in range(0, len(ys), step):
+        y = ys[i:i + step, numpy.newaxis]
+
+        # half open test, so a vertex is only crossed once
+        crosses = ((y0 <= y) & (y1 > y)) | ((y1 <= y) & (y0 > y))
+        xs = numpy.where(crosses, x0 + (y - y0) / dy * (x1 - x0), numpy.inf)
+        xs.sort(axis=1)
+        xs = xs[:, :crosses.sum(axis=1).max()]
+
+        starts = xs[:, 0::2]
+        ends = xs[:, 1::2]
+        found = numpy.isfinite(ends)
+        rows = numpy.repeat(lines[i:i + step, numpy.newaxis], starts.shape[1], axis=1)[found]
+
+        a = numpy.clip((starts[found] - extent[0]) / cellsize, 0, xcount)
+        b = numpy.clip((ends[found] - extent[0]) / cellsize, 0, xcount)
+        keep = b > a
+        add_spans(cover, full, rows[keep], a[keep], b[keep])
+
+def coverage_by_scanline(lyr, extent, cellsize, xcount, ycount, dst_band, subrows=SUBROWS):
+    """
+    Visit each polygon once and accumulate the area it covers in every cell
+    """
+    cover = numpy.zeros((ycount, xcount))
+    full = numpy.zeros((ycount, xcount + 1))
+
+    lyr.SetSpatialFilterRect(extent[0], extent[3] - ycount * cellsize,
+                             extent[0] + xcount * cellsize, extent[3])
+    featnum = 0
+    feat = lyr.GetNextFeature()
+    while feat is not None:
+        geom = feat.GetGeometryRef()
+        edges = None
+        if geom is not None:
+            edges = polygon_edges(geom)
+        if edges is not None:
+            add_coverage(cover, full, edges, extent, cellsize, subrows)
+        featnum += 1
+        if featnum % 100 == 0:
+            print '%d features processed' % featnum
+        feat = lyr.GetNextFeature()
+    lyr.SetSpatialFilter(None)
+
+    cover += numpy.cumsum(full, axis=1)[:, :xcount]
+    pct_cover = cover / subrows * 100
+
+    for ypos in range(0, ycount, 256):
+        dst_band.WriteArray(pct_cover[ypos:ypos + 256].astype(numpy.float32), 0, ypos)
+
+def density_by_intersection(lyr, extent, cellsize, xcount, ycount, dst_band):
+    """
+    Intersect every cell polygon with the features under it
+    """
     pixelnum = 0
     
     for ypos in range(ycount):
         # Create output line array
-        outArray = Numeric.zeros( (1, xcount) )
+        outArray = numpy.zeros( (1, xcount) )
         for xpos in range(xcount):
             # create a 4-item list of extents 
             minx = xpos * cellsize + extent[0] 
@@ -96,10 +206,42 @@ if __name__ == "__main__":
             pct_cover = area / (cellsize*cellsize)
 
             #Assign percent areal cover as value in line array
-            Numeric.put( outArray, xpos, (pct_cover*100) )
+            outArray[0, xpos] = pct_cover*100
 
             pixelnum += 1
  
         print '%.2f pct complete' % (float(pixelnum)/(xcount*ycount) * 100.)
         dst_band.WriteArray(outArray,0,ypos)
+   
+if __name__ == "__main__":
+    # Get the inputs
+    (poly_ds,poly_lyr,extent,cellsize,outfile,format,scanline) = getOpts()    
+
+    # Get the input layer
+    ds = ogr.Open(poly_ds)
+    lyr = ds.GetLayer(poly_lyr)
+    
+    # TODO: Confirm dataset is polygon and extents overlap 
+
+    ydist = extent[3] - extent[1]
+    xdist = extent[2] - extent[0]
+    xcount = int((xdist/cellsize)+1)
+    ycount = int((ydist/cellsize)+1)
+
+    # Create output raster  
+    driver = gdal.GetDriverByName( format )
+    dst_ds = driver.Create( outfile, xcount, ycount, 1, gdal.GDT_Float32 )
+
+    # the GT(2) and GT(4) coefficients are zero,     
+    # and the GT(1) is pixel width, and GT(5) is pixel height.     
+    # The (GT(0),GT(3)) position is the top left corner of the top left pixel
+    gt = (extent[0],cellsize,0,extent[3],0,(cellsize*-1.))
+    dst_ds.SetGeoTransform(gt)
+    
+    dst_band = dst_ds.GetRasterBand(1)
+    dst_band.SetNoDataValue( -9999 )
 
+    if scanline:
+        coverage_by_scanline(lyr, extent, cellsize, xcount, ycount, dst_band)
+    else:
+        density_by_intersection(lyr, extent, cellsize, xcount, ycount, dst_band)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+ poly_density_bench.py
+ Check poly_density.py's scanline coverage against the exact covered area of
+ every cell on random polygons (with holes, and running off the raster edge),
+ and against the per-cell intersection it replaced. Prints the time each
+ method takes.
+
+    python poly_density_bench.py [polygons] [trials]
+"""
+import sys
+import time
+import numpy
+import ogr
+from poly_density import coverage_by_scanline, density_by_intersection, SUBROWS
+
+EXTENT = [500., 200., 700., 350.]
+CELLSIZE = 10.
+XCOUNT = 20
+YCOUNT = 15
+
+class ArrayBand:
+    """ Just enough of a gdal band to collect what the methods write """
+    def __init__(self, xcount, ycount):
+        self.a = numpy.zeros((ycount, xcount))
+
+    def WriteArray(self, a, xoff, yoff):
+        self.a[yoff:yoff + a.shape[0], xoff:xoff + a.shape[1]] = a
+
+def star_ring(rng, cx, cy, radius, clockwise=False):
+    """ A star shaped ring around (cx, cy), counter-clockwise unless asked """
+    # one vertex in each of n sectors keeps every gap under half a turn,
+    # so the centre stays inside and the ring cannot cross itself
+    n = rng.randint(5, 16)
+    angles = (numpy.arange(n) + rng.rand(n)) * 2 * numpy.pi / n
+    radii = radius * rng.uniform(0.4, 1.0, n)
+    ring = zip(cx + radii * numpy.cos(angles), cy + radii * numpy.sin(angles))
+    if clockwise:
+        ring.reverse()
+    return ring
+
+def random_polygon(rng):
+    """ Rings of a random polygon near the extent, sometimes with a hole """
+    cx = rng.uniform(EXTENT[0] - 20, EXTENT[2] + 20)
+    cy = rng.uniform(EXTENT[1] - 20, EXTENT[3] + 20)
+    radius = rng.uniform(2, 60)
+    rings = [star_ring(rng, cx, cy, radius)]
+    if rng.rand() < 0.3:
+        # Keep the hole inside the closest outer edge
+        x, y = numpy.array(rings[0]).T - [[cx], [cy]]
+        cross = x * numpy.roll(y, -1) - numpy.roll(x, -1) * y
+        lengths = numpy.hypot(x - numpy.roll(x, -1), y - numpy.roll(y, -1))
+        rings.append(star_ring(rng, cx, cy, 0.9 * (cross / lengths).min(), clockwise=True))
+    return rings
+
+def random_rectangle(rng):
+    """ An axis-aligned rectangle whose top and bottom lie between scanlines """
+    step = CELLSIZE / SUBROWS
+    y0, y1 = sorted(rng.randint(-20, YCOUNT * SUBROWS + 20, 2))
+    x0, x1 = sorted(rng.uniform(EXTENT[0] - 20, EXTENT[2] + 20, 2))
+    top = EXTENT[3] - y0 * step
+    bottom = EXTENT[3] - (y1 + 1) * step
+    return [[(x0, bottom), (x1, bottom), (x1, top), (x0, top)]]
+
+def polygon_wkt(rings):
+    return 'POLYGON (%s)' % ', '.join(
+        ['(%s)' % ', '.join(['%r %r' % p for p in ring + ring[:1]]) for ring in rings])
+
+def memory_layer(polygons):
+    """ An in-memory OGR layer holding one feature per polygon """
+    ds = ogr.GetDriverByName('Memory').CreateDataSource('bench')
+    lyr = ds.CreateLayer('polygons', geom_type=ogr.wkbPolygon)
+    for rings in polygons:
+        feat = ogr.Feature(lyr.GetLayerDefn())
+        feat.SetGeometry(ogr.CreateGeometryFromWkt(polygon_wkt(rings)))
+        lyr.CreateFeature(feat)
+    return ds, lyr
+
+def clip_ring(ring, minx, miny, maxx, maxy):
+    """ Sutherland-Hodgman clip of a ring to a box """
+    for axis, limit, keep_above in ((0, minx, True), (0, maxx, False),
+                                    (1, miny, True), (1, maxy, False)):
+        if not ring:
+            break
+        inside = lambda p: (p[axis] >= limit) == keep_above
+        out = []
+        for i in range(len(ring)):
+            p, q = ring[i - 1], ring[i]
+            if inside(q) != inside(p):
+                t = (limit - p[axis]) / (q[axis] - p[axis])
+                out.append((p[0] + t * (q[0] - p[0]), p[1] + t * (q[1] - p[1])))
+            if inside(q):
+                out.append(q)
+        ring = out
+    return ring
+
+def signed_area(ring):
+    if len(ring) < 3:
+        return 0.0
+    x, y = numpy.array(ring).T
+    return 0.5 * (x * numpy.roll(y, -1) - numpy.roll(x, -1) * y).sum()
+
+def exact_cover(polygons):
+    """ Percent cover of every cell, from the exact clipped area of each ring """
+    cover = numpy.zeros((YCOUNT, XCOUNT))
+    for ypos in range(YCOUNT):
+        maxy = EXTENT[3] - ypos * CELLSIZE
+        for xpos in range(XCOUNT):
+            minx = EXTENT[0] + xpos * CELLSIZE
+            for rings in polygons:
+                # outer rings run counter-clockwise and holes clockwise
+                for ring in rings:
+                    cover[ypos, xpos] += signed_area(
+                        clip_ring(ring, minx, maxy - CELLSIZE, minx + CELLSIZE, maxy))
+    return cover / (CELLSIZE * CELLSIZE) * 100
+
+def run(method, lyr):
+    band = ArrayBand(XCOUNT, YCOUNT)
+    start = time.time()
+    method(lyr, EXTENT, CELLSIZE, XCOUNT, YCOUNT, band)
+    return band.a, time.time() - start
+
+def check(count, trials, seed=0):
+    """
+    Compare the methods on trials random layers of count polygons each,
+    return the failures and the time each method took
+    """
+    rng = numpy.random.RandomState(seed)
+    failures = []
+    times = {'scanline': 0.0, 'intersection': 0.0}
+    for trial in range(trials):
+        # Rectangles between scanlines are covered exactly, up to Float32
+        rects = [random_rectangle(rng) for i in range(count)]
+        ds, lyr = memory_layer(rects)
+        scan, seconds = run(coverage_by_scanline, lyr)
+        diff = numpy.abs(scan - exact_cover(rects)).max()
+        if diff > 1e-3:
+            failures.append((trial, 'rectangles', 'exact', diff))
+
+        # Slanted edges are only sampled SUBROWS times per row
+        polygons = [random_polygon(rng) for i in range(count)]
+        ds, lyr = memory_layer(polygons)
+        scan, seconds = run(coverage_by_scanline, lyr)
+        times['scanline'] += seconds
+        slow, seconds = run(density_by_intersection, lyr)
+        times['intersection'] += seconds
+        for name, expected in (('exact', exact_cover(polygons)), ('intersection', slow)):
+            diff = numpy.abs(scan - expected)
+            if diff.max() > 200.0 / SUBROWS or diff.sum() > 0.01 * expected.sum():
+                failures.append((trial, 'polygons', name, diff.max()))
+    return failures, times
+
+if __name__ == '__main__':
+    count = 40
+    trials = 5
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        trials = int(sys.argv[2])
+
+    print 'checking %d layers of %d random polygons...' % (trials, count)
+    failures, times = check(count, trials)
+    print 'scanline:     %.2f s' % times['scanline']
+    print 'intersection: %.2f s' % times['intersection']
+
+    if failures:
+        for failure in failures:
+            print 'MISMATCH trial %d, %s against %s: off by %.3f pct' % failure
+        sys.exit(1)
+    print 'outputs match'
@@ -6,25 +6,185 @@
  Apache 2.0 License
 """
 
-import gdal
-import Numeric
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+import numpy
 import sys
+from block_cache import CachedBand
 
-def getRasterValue(x,y,datasource,window=3,bandnum=1):
-    ds = gdal.Open(datasource)
-    band = ds.GetRasterBand(bandnum)
-    gt = ds.GetGeoTransform()
-    xoff = int((x - gt[0]) / gt[1]) - int(window/2) 
-    yoff = int((y - gt[3]) / gt[5]) - int(window/2) 
-    xsize = window 
-    ysize = window 
-    try:
-        a = band.ReadAsArray( xoff, yoff, xsize, ysize)
-        avg_value = Numeric.sum( Numeric.sum(a) ) / Numeric.size(a)
-        return avg_value
-    except:
+class RasterSampler:
+    """
+    Sample a raster band at many coordinates at once
+
+    Keeps the dataset open and reads each block the points fall in only
+    once, through a block_cache.BlockCache. Samplers can share a cache.
+
+        sampler = RasterSampler('dem.tif')
+        elevs = sampler.sample(xs, ys, method='bilinear')
+
+    Points off the raster (or on nodata) come back as the fill value.
+    """
+    def __init__(self, datasource, bandnum=1, fill=numpy.nan, cache=None):
+        if isinstance(datasource, basestring):
+            self.ds = gdal.Open(datasource)
+        else:
+            self.ds = datasource
+        self.band = CachedBand(self.ds, bandnum, cache)
+        self.cache = self.band.cache
+        self.xsize = self.band.XSize
+        self.ysize = self.band.YSize
+        self.blockx, self.blocky = self.band.blockx, self.band.blocky
+        self.nodata = self.band.GetNoDataValue()
+        self.fill = fill
+
+        # Invert the affine geotransform to go from map to pixel coordinates
+        gt = self.ds.GetGeoTransform()
+        det = gt[1] * gt[5] - gt[2] * gt[4]
+        self.origin = (gt[0], gt[3])
+        self.inverse = (gt[5] / det, -gt[2] / det, -gt[4] / det, gt[1] / det)
+
+    def pixel(self, xs, ys):
+        """ Return fractional pixel/line positions for arrays of map coords """
+        dx = numpy.asarray(xs, dtype=numpy.float64) - self.origin[0]
+        dy = numpy.asarray(ys, dtype=numpy.float64) - self.origin[1]
+        inv = self.inverse
+        return inv[0] * dx + inv[1] * dy, inv[2] * dx + inv[3] * dy
+
+    def _gather(self, cols, rows):
+        """
+        Look up integer pixel positions, all of which must be on the raster,
+        visiting the points block by block
+        """
+        values = numpy.empty(len(cols), dtype=numpy.float64)
+        if not len(cols):
+            return values
+        bxs = cols // self.blockx
+        bys = rows // self.blocky
+        keys = bys * (self.xsize // self.blockx + 1) + bxs
+        order = numpy.argsort(keys, kind='mergesort')
+        bounds = numpy.flatnonzero(numpy.diff(keys[order])) + 1
+        for group in numpy.split(order, bounds):
+            bx = bxs[group[0]]
+            by = bys[group[0]]
+            data = self.band.block(bx, by)
+            values[group] = data[rows[group] - by * self.blocky,
+                                 cols[group] - bx * self.blockx]
+        return values
+
+    def _lookup(self, cols, rows):
+        """ Like _gather, but off-raster and nodata cells become NaN """
+        values = numpy.empty(len(cols), dtype=numpy.float64)
+        values.fill(numpy.nan)
+        inside = (cols >= 0) & (cols < self.xsize) & (rows >= 0) & (rows < self.ysize)
+        values[inside] = self._gather(cols[inside], rows[inside])
+        if self.nodata is not None:
+            values[values == self.nodata] = numpy.nan
+        return values
+
+    def nearest(self, px, py):
+        return self._lookup(numpy.floor(px).astype(numpy.int64),
+                            numpy.floor(py).astype(numpy.int64))
+
+    def bilinear(self, px, py):
+        """
+        Interpolate between the four nearest cell centres; within half a
+        cell of the raster edge the edge cells are repeated. Nodata
+        neighbours are left out and the other weights scaled up to make
+        up for them, but a point in a nodata cell has no value.
+        """
+        inside = (px >= 0) & (px < self.xsize) & (py >= 0) & (py < self.ysize)
+        fx = numpy.clip(px - 0.5, 0, self.xsize - 1)
+        fy = numpy.clip(py - 0.5, 0, self.ysize - 1)
+        c0 = numpy.floor(fx).astype(numpy.int64)
+        r0 = numpy.floor(fy).astype(numpy.int64)
+        c1 = numpy.minimum(c0 + 1, self.xsize - 1)
+        r1 = numpy.minimum(r0 + 1, self.ysize - 1)
+        wx = fx - c0
+        wy = fy - r0
+        corners = [(self._lookup(c0, r0), (1 - wx) * (1 - wy)),
+                   (self._lookup(c1, r0), wx * (1 - wy)),
+                   (self._lookup(c0, r1), (1 - wx) * wy),
+                   (self._lookup(c1, r1), wx * wy)]
+        total = numpy.zeros(len(px))
+        weights = numpy.zeros(len(px))
+        for values, weight in corners:
+            valid = ~numpy.isnan(values)
+            total[valid] += values[valid] * weight[valid]
+            weights[valid] += weight[valid]
+
+        # The cell the point is in is the corner nearest to it
+        right = wx >= 0.5
+        below = wy >= 0.5
+        own = numpy.where(below, numpy.where(right, corners[3][0], corners[2][0]),
+                                 numpy.where(right, corners[1][0], corners[0][0]))
+        values = numpy.empty(len(px))
+        values.fill(numpy.nan)
+        # Clipping pulls points off the raster onto its edge cells
+        found = inside & (weights > 0) & ~numpy.isnan(own)
+        values[found] = total[found] / weights[found]
+        return values
+
+    def mean(self, px, py, window=3):
+        """
+        Average the window x window cells around each point, skipping nodata.
+        Windows running off the raster give no value
+        """
+        cols = numpy.floor(px).astype(numpy.int64) - window / 2
+        rows = numpy.floor(py).astype(numpy.int64) - window / 2
+        total = numpy.zeros(len(cols))
+        count = numpy.zeros(len(cols))
+        offraster = numpy.zeros(len(cols), dtype=bool)
+        for j in range(window):
+            for i in range(window):
+                values = self._lookup(cols + i, rows + j)
+                offraster |= (cols + i < 0) | (cols + i >= self.xsize) | \
+                             (rows + j < 0) | (rows + j >= self.ysize)
+                valid = ~numpy.isnan(values)
+                total[valid] += values[valid]
+                count[valid] += 1
+        values = numpy.empty(len(cols))
+        values.fill(numpy.nan)
+        found = (count > 0) & ~offraster
+        values[found] = total[found] / count[found]
+        return values
+
+    def sample(self, xs, ys, method='nearest', window=3):
+        """
+        Return an array of band values at map coordinates xs, ys
+
+        method is 'nearest', 'bilinear' or 'mean' (of a window x window
+        neighbourhood)
+        """
+        px, py = self.pixel(numpy.atleast_1d(xs), numpy.atleast_1d(ys))
+        if method == 'nearest':
+            values = self.nearest(px, py)
+        elif method == 'bilinear':
+            values = self.bilinear(px, py)
+        elif method == 'mean':
+            values = self.mean(px, py, window)
+        else:
+            raise ValueError("Unknown sampling method '%s'" % method)
+        values[numpy.isnan(values)] = self.fill
+        return values
+
+def getRasterValue(x,y,datasource,window=3,bandnum=1,cache=None):
+    """
+    Mean of the window x window cells around one point, or None off the
+    raster. Kept for old callers: datasource may be a RasterSampler, but
+    anything else is opened again on every call, so loops over points
+    should make one sampler and call its sample() with arrays instead.
+    """
+    if isinstance(datasource, RasterSampler):
+        sampler = datasource
+    else:
+        sampler = RasterSampler(datasource, bandnum, cache=cache)
+    avg_value = sampler.sample([x], [y], 'mean', window)[0]
+    if numpy.isnan(avg_value):
         print "Coordinates out of range"
         return None
+    return avg_value
 
     
 if __name__ == "__main__":
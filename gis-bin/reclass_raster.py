@@ -23,11 +23,26 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 ###############################################################################
+USAGE = """
+Reclassify raster from continuous values to discrete classes
+Example usage:
+    python reclass_raster.py [-nodata value] input.tif classes.cfg output.tif
+
+where classes.cfg contains lines like:
+    min,max,class
+
+Cells that are nodata or fall into no class get the output nodata value:
+-nodata if given, else the input band's nodata, else -9999. It must not be
+one of the classes.
+"""
 import sys
 import numpy
 from osgeo import gdal
 from progressbar import ProgressBar, Percentage, ETA, SimpleProgress
 
+# Output nodata when neither -nodata nor the input band gives one
+NODATA = -9999
+
 def parse_config(fh):
     lines = fh.readlines()
     cfg = []
@@ -49,14 +64,76 @@ def classify_val(val, cfg):
             return rule[2]
     print "WARNING: value %s did not fall into any class"
     return None
+
+def compile_config(cfg):
+    """
+    Compile the min,max,class rules into a lookup table.
+
+    Every rule boundary becomes an edge; each interval between consecutive
+    edges takes the class of the first rule covering it, the same first-match
+    precedence as classify_val.
+
+    Returns (edges, classes, matched) where classes[i] and matched[i]
+    describe values in [edges[i], edges[i+1]).  The extra last entry stands
+    for values outside all edges and is never matched.
+    """
+    edges = numpy.unique([rule[0] for rule in cfg] + [rule[1] for rule in cfg])
+    classes = numpy.zeros(len(edges), dtype=numpy.int16)
+    matched = numpy.zeros(len(edges), dtype=bool)
+    for rule in reversed(cfg):
+        covered = (edges[:-1] >= rule[0]) & (edges[1:] <= rule[1])
+        classes[:-1][covered] = int(rule[2])
+        matched[:-1][covered] = True
+    return edges, classes, matched
+
+def choose_nodata(cfg, nodata=None, innodata=None):
+    """
+    Pick the output nodata value: nodata if given, else innodata if it
+    fits in an Int16 and isn't a class, else NODATA. Raises ValueError
+    if the value picked is one of the classes.
+    """
+    classes = set([int(rule[2]) for rule in cfg])
+    if nodata is None:
+        nodata = NODATA
+        if innodata is not None and innodata == int(innodata) and \
+           -32768 <= innodata <= 32767 and int(innodata) not in classes:
+            nodata = int(innodata)
+    if nodata in classes:
+        raise ValueError("nodata value %s is also a class" % nodata)
+    return nodata
+
+def classify_block(data, table, nodata=None, out_nodata=NODATA):
+    """
+    Classify a whole array of values with a table from compile_config.
+
+    Returns (zones, unmatched): zones is out_nodata wherever the input is
+    nodata or falls into no class, unmatched counts the latter.
+    """
+    edges, classes, matched = table
+    idx = numpy.searchsorted(edges, data, side='right') - 1
+    idx[(idx < 0) | (idx >= len(edges) - 1)] = len(edges) - 1
+    unmatched = ~matched[idx]
+
+    zones = classes[idx]
+    zones[unmatched] = out_nodata
+    if nodata is not None:
+        isnodata = data == nodata
+        zones[isnodata] = out_nodata
+        unmatched &= ~isnodata
+    return zones, numpy.count_nonzero(unmatched)
     
 if __name__ == '__main__':
     format = 'GTiff'
 
     gdal.AllRegister()
     argv = gdal.GeneralCmdLineProcessor( sys.argv )
+    nodata = None
+    if '-nodata' in argv[:-1]:
+        i = argv.index('-nodata')
+        nodata = int(argv[i + 1])
+        argv = argv[:i] + argv[i + 2:]
     if len(argv) < 4:
-        print "python reclass_raster.py input.tif classes.cfg output.tif"
+        print USAGE
         sys.exit( 0 )
 
     cont = gdal.Open( argv[1], gdal.GA_ReadOnly )
@@ -68,7 +145,7 @@ if __name__ == '__main__':
         cfg_fh = open(argv[2], 'r')
         cfg = parse_config(cfg_fh) 
     except:
-        print "Configuration file '%s' is not valid" % argv[4]
+        print "Configuration file '%s' is not valid" % argv[2]
         sys.exit( 0 )
 
     geotransform = cont.GetGeoTransform()
@@ -96,22 +173,37 @@ if __name__ == '__main__':
         out.SetProjection(projection)
 
     inband = cont.GetRasterBand(1)
-    indata = inband.ReadAsArray()
+    innodata = inband.GetNoDataValue()
+    table = compile_config(cfg)
+    try:
+        out_nodata = choose_nodata(cfg, nodata, innodata)
+    except ValueError, e:
+        print "Can't use nodata value:", e
+        sys.exit( 1 )
 
     outband = out.GetRasterBand(1) 
+    outband.SetNoDataValue(out_nodata)
+
+    # Stream through the input in its native blocks
+    xblock, yblock = inband.GetBlockSize()
 
     progress = ProgressBar(widgets=['Processed Lines ', SimpleProgress(), ' (', Percentage(), ') ' , ETA(), ' remaining' ],maxval=ysize)
     progress.start()
     progress.update_interval = 1
     progress.next_update = 1
 
-    for line in range(ysize):
-        zones_line = []
-        for xpos in range(xsize):
-            val = indata[line, xpos]
-            zone = classify_val(val, cfg)
-            zones_line.append(zone)
-        outband.WriteArray( numpy.array([zones_line]), 0, line )   
-        progress.update(line)
+    unmatched = 0
+    for yoff in range(0, ysize, yblock):
+        rows = min(yblock, ysize - yoff)
+        for xoff in range(0, xsize, xblock):
+            cols = min(xblock, xsize - xoff)
+            indata = inband.ReadAsArray(xoff, yoff, cols, rows)
+            zones, missed = classify_block(indata, table, innodata, out_nodata)
+            outband.WriteArray(zones, xoff, yoff)
+            unmatched += missed
+        progress.update(yoff + rows - 1)
 
-    print 
\ No newline at end of file
+    print 
+    if unmatched:
+        print "WARNING: %d values did not fall into any class" % unmatched
+    out = None
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+ sampler_bench.py
+ Check rasterQuery.RasterSampler's nearest, bilinear and mean sampling
+ against a point by point lookup on a tiled raster with nodata holes, for
+ points on, near and off every edge, then time sampling many points.
+
+    python sampler_bench.py [size] [points]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy
+from osgeo import gdal
+from rasterQuery import RasterSampler
+
+NODATA = -9999
+
+def random_raster(path, size, rng):
+    """ Write a size x size tiled GeoTIFF of noise with some nodata, return the array """
+    a = rng.uniform(0, 1000, (size, size)).astype(numpy.float32)
+    a[rng.rand(size, size) < 0.05] = NODATA
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(path, size, size, 1, gdal.GDT_Float32,
+                       ['TILED=YES', 'BLOCKXSIZE=64', 'BLOCKYSIZE=64'])
+    # north up, so map y runs from 0 at the top to -size at the bottom
+    ds.SetGeoTransform([0, 1, 0, 0, 0, -1])
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(NODATA)
+    band.WriteArray(a, 0, 0)
+    band = None
+    ds = None
+    return a
+
+def cell(a, col, row):
+    """ The value of one cell, NaN off the raster or on nodata """
+    if not (0 <= col < a.shape[1] and 0 <= row < a.shape[0]) or a[row, col] == NODATA:
+        return numpy.nan
+    return float(a[row, col])
+
+def brute_nearest(a, px, py):
+    return cell(a, int(numpy.floor(px)), int(numpy.floor(py)))
+
+def brute_bilinear(a, px, py):
+    rows, cols = a.shape
+    if not (0 <= px < cols and 0 <= py < rows):
+        return numpy.nan
+    if numpy.isnan(cell(a, int(px), int(py))):
+        return numpy.nan
+    fx = min(max(px - 0.5, 0), cols - 1)
+    fy = min(max(py - 0.5, 0), rows - 1)
+    c0, r0 = int(fx), int(fy)
+    wx, wy = fx - c0, fy - r0
+    total = weights = 0.0
+    for col, row, weight in ((c0, r0, (1 - wx) * (1 - wy)),
+                             (min(c0 + 1, cols - 1), r0, wx * (1 - wy)),
+                             (c0, min(r0 + 1, rows - 1), (1 - wx) * wy),
+                             (min(c0 + 1, cols - 1), min(r0 + 1, rows - 1), wx * wy)):
+        value = cell(a, col, row)
+        if not numpy.isnan(value):
+            total += value * weight
+            weights += weight
+    if weights == 0:
+        return numpy.nan
+    return total / weights
+
+def brute_mean(a, px, py, window=3):
+    col = int(numpy.floor(px)) - window / 2
+    row = int(numpy.floor(py)) - window / 2
+    if col < 0 or row < 0 or col + window > a.shape[1] or row + window > a.shape[0]:
+        return numpy.nan
+    values = a[row:row + window, col:col + window]
+    values = values[values != NODATA]
+    if not len(values):
+        return numpy.nan
+    return values.astype(numpy.float64).mean()
+
+def random_points(rng, size, count):
+    """ Map coordinates spread a little past every edge, some exactly on one """
+    xs = rng.uniform(-3, size + 3, count)
+    ys = -rng.uniform(-3, size + 3, count)
+    edges = rng.rand(count) < 0.1
+    xs[edges] = rng.choice([0, size, -0.5, size + 0.5], edges.sum())
+    return xs, ys
+
+def check(path, a, rng, count):
+    """ Compare count random points for every method, return the failures """
+    sampler = RasterSampler(path)
+    xs, ys = random_points(rng, a.shape[0], count)
+    failures = []
+    for method, brute in (('nearest', brute_nearest), ('bilinear', brute_bilinear),
+                          ('mean', brute_mean)):
+        values = sampler.sample(xs, ys, method)
+        expected = numpy.array([brute(a, x, -y) for x, y in zip(xs, ys)])
+        bad = numpy.isnan(values) != numpy.isnan(expected)
+        found = ~numpy.isnan(expected) & ~bad
+        bad[found] = ~numpy.isclose(values[found], expected[found], rtol=1e-9, atol=1e-6)
+        for i in numpy.flatnonzero(bad):
+            failures.append((method, xs[i], ys[i], values[i], expected[i]))
+    return failures
+
+if __name__ == '__main__':
+    size = 2048
+    points = 1000000
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        points = int(sys.argv[2])
+
+    rng = numpy.random.RandomState(0)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print 'checking small rasters against point by point lookups...'
+        failures = []
+        for small in (1, 2, 7, 100):
+            path = os.path.join(tmpdir, 'small%d.tif' % small)
+            failures += check(path, random_raster(path, small, rng), rng, 2000)
+
+        path = os.path.join(tmpdir, 'big.tif')
+        random_raster(path, size, rng)
+        xs, ys = random_points(rng, size, points)
+        for method in ('nearest', 'bilinear', 'mean'):
+            sampler = RasterSampler(path)
+            start = time.time()
+            sampler.sample(xs, ys, method)
+            print '%8s, %d points on %d x %d: %.2f s' % (method, points, size, size,
+                                                        time.time() - start)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    if failures:
+        for failure in failures[:20]:
+            print 'MISMATCH %s at (%r, %r): %r, expected %r' % failure
+        sys.exit(1)
+    print 'outputs match'
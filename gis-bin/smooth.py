@@ -1,13 +1,12 @@
 #!/usr/bin/env python
 import gdal
-import Numeric
+import numpy
 import sys
-from math import sqrt
+import optparse
+from focal import neighbourhood, focal_block, read_with_halo
 
 #####
-# TO DO: 
-# output floating point data
-# change window size
+# TO DO:
 # preserve edges (?)
 #####
 
@@ -17,87 +16,80 @@ from math import sqrt
 noDataValue = -12345.0
 debug = False
 
-#**********************************#
-#  Inputs
-try:
-    raster = sys.argv[1]
-    outfile = sys.argv[2]
-except:
-    print "smooth.py raster outfile"
+# Rows per strip are rounded up to whole blocks of the input
+STRIP_ROWS = 256
+
+KERNELS = ('box', 'circle', 'gaussian')
 
 #**********************************#
 #  Functions
-def testNull(x,nodata):
-    hasNull = False
-    for i in x:
-        if not i or i == nodata:
-            return True
-    return False
-
-        
-#**********************************#
-#  Main
-if __name__ == "__main__" :
-    ds = gdal.Open(raster)
+def make_kernel(kind, size):
+    """
+    Return a size x size array of weights for a focal window
+    """
+    r = size / 2
+    y, x = numpy.mgrid[-r:r + 1, -r:r + 1]
+    if kind == 'box':
+        kernel = numpy.ones((size, size))
+    elif kind == 'circle':
+        kernel = (x * x + y * y <= r * r + r).astype(numpy.float64)
+    elif kind == 'gaussian':
+        sigma = max(size / 4.0, 0.5)
+        kernel = numpy.exp(-(x * x + y * y) / (2 * sigma * sigma))
+    else:
+        raise ValueError("Unknown kernel '%s'" % kind)
+    return kernel
 
-    inArray = ds.GetRasterBand(1).ReadAsArray()
-    inNoDataValue = ds.GetRasterBand(1).GetNoDataValue()
-  
-    gt = ds.GetGeoTransform()
-
-    outArray = Numeric.zeros( (ds.RasterYSize, ds.RasterXSize) ) 
-
-    row = 0
-    col = 0
-    pixelnum = 0
-
-    for i in inArray:
-        for j in i:
-            # Make c[0] empty so that we can use number scheme 
-            # consistent with Grass source code 
-            # (from which all of these algorithms are derived)
-            # 3x3 window
-            #  c1 c2 c3
-            #  c4 c5 c6
-            #  c7 c8 c9
-            #
-            total = 0
-            hasNull = False
-            try:
-                c = ( 0, 
-                      inArray[row-1][col-1],
-                      inArray[row-1][col],
-                      inArray[row-1][col+1],
-                      inArray[row][col-1],
-                      inArray[row][col],
-                      inArray[row][col+1],
-                      inArray[row+1][col-1],
-                      inArray[row+1][col],
-                      inArray[row+1][col+1] )
-            except:
-                # Probably means we're at an edge 
-                hasNull = True
- 
-            if hasNull or testNull(c,inNoDataValue):
-                # In this case, we bail and write null to the array
-                Numeric.put(outArray,pixelnum,noDataValue)
-                pixelnum += 1	
-                col += 1
+def focal_mean(data, valid, kernel):
+    """
+    Weighted mean of the valid cells under the kernel around each cell
+
+    data and valid carry a halo of kernel.shape/2 cells on every side and
+    the result covers only the interior. Cells with no valid neighbours
+    (or that are not valid themselves) come back as noDataValue.
+    """
+    ky, kx = kernel.shape
+    rows = data.shape[0] - ky + 1
+    cols = data.shape[1] - kx + 1
+    values = numpy.where(valid, data, 0).astype(numpy.float64)
+
+    total = numpy.zeros((rows, cols))
+    weight = numpy.zeros((rows, cols))
+    for j in range(ky):
+        for i in range(kx):
+            w = kernel[j, i]
+            if w == 0:
                 continue
-            
-            for i in c:
-                total += i
-            
-            Numeric.put(outArray,pixelnum,(total/9.0))         
-                
-            pixelnum += 1	
-            col += 1
-
-        row += 1
-        col = 0
-
-    # Output the Array
-    format = "GTiff"
+            total += w * values[j:j + rows, i:i + cols]
+            weight += w * valid[j:j + rows, i:i + cols]
+
+    center = valid[ky / 2:ky / 2 + rows, kx / 2:kx / 2 + cols]
+    found = center & (weight > 0)
+    out = numpy.empty((rows, cols), dtype=numpy.float32)
+    out.fill(noDataValue)
+    out[found] = total[found] / weight[found]
+    return out
+
+def box_mean(data, valid, shape, size):
+    """
+    Unweighted mean over a box or circle, from focal's summed-area tables
+    """
+    runs = neighbourhood(shape, size)
+    mean = focal_block(data, valid, 'mean', runs)
+    r = size / 2
+    found = valid[r:r + mean.shape[0], r:r + mean.shape[1]] & ~numpy.isnan(mean)
+    out = numpy.empty(mean.shape, dtype=numpy.float32)
+    out.fill(noDataValue)
+    out[found] = mean[found]
+    return out
+
+def smooth(ds, outfile, kind, size, format="GTiff"):
+    band = ds.GetRasterBand(1)
+    inNoDataValue = band.GetNoDataValue()
+    halo = size / 2
+    if kind == 'gaussian':
+        kernel = make_kernel(kind, size)
+
     driver = gdal.GetDriverByName( format )
     dst_ds = driver.Create( outfile, ds.RasterXSize, ds.RasterYSize, 1, gdal.GDT_Float32 )
     if ds.GetGeoTransform():
@@ -105,7 +97,44 @@ if __name__ == "__main__" :
     if ds.GetMetadata():
         dst_ds.SetMetadata(ds.GetMetadata())
     if ds.GetProjection():
-        dst_ds.SetProjection(ds.GetProjection()) 
-    dst_ds.GetRasterBand(1).SetNoDataValue( noDataValue )   
-    dst_ds.GetRasterBand(1).WriteArray( outArray )
+        dst_ds.SetProjection(ds.GetProjection())
+    dst_band = dst_ds.GetRasterBand(1)
+    dst_band.SetNoDataValue( noDataValue )
+
+    blocky = band.GetBlockSize()[1]
+    strip = max(1, (STRIP_ROWS + blocky - 1) / blocky) * blocky
+
+    for yoff in range(0, ds.RasterYSize, strip):
+        rows = min(strip, ds.RasterYSize - yoff)
+        data, valid = read_with_halo(band, yoff, rows, halo, halo, inNoDataValue)
+        if kind == 'gaussian':
+            out = focal_mean(data, valid, kernel)
+        else:
+            out = box_mean(data, valid, {'box': 'rect'}.get(kind, kind), size)
+        dst_band.WriteArray( out, 0, yoff )
+        if debug:
+            print "%d of %d rows" % (yoff + rows, ds.RasterYSize)
 
+    return dst_ds
+
+
+#**********************************#
+#  Main
+if __name__ == "__main__" :
+    parser = optparse.OptionParser('usage: smooth.py [options] raster outfile')
+    parser.add_option('-w', '--window', dest='window', type='int', default=3,
+                      help='window size in cells, odd [default: 3]')
+    parser.add_option('-k', '--kernel', dest='kernel', default='box',
+                      help='one of %s [default: box]' % ', '.join(KERNELS))
+    (options, args) = parser.parse_args()
+
+    if len(args) != 2:
+        parser.error("smooth.py raster outfile")
+    if options.window < 1 or options.window % 2 == 0:
+        parser.error("window size must be a positive odd number")
+    if options.kernel not in KERNELS:
+        parser.error("kernel must be one of %s" % ', '.join(KERNELS))
+
+    raster, outfile = args
+    ds = gdal.Open(raster)
+    smooth(ds, outfile, options.kernel, options.window)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""
+ tile_store.py
+ Where generate_tiles.py puts its tiles: z/x/y.png files under a directory,
+ or a single MBTiles (SQLite) file.
+
+    store = open_store('tiles.mbtiles', name='osm', bbox=bbox, minzoom=9, maxzoom=17)
+    store.put(z, x, y, png_data)
+    store.mark_completed(chunk_id)
+    store.commit()
+    store.close()
+
+ Stores also remember which chunks of a render finished, so restarts can
+ skip them. In an MBTiles file that record is written in the same
+ transaction as the chunk's tiles. The record is tied to the parameters
+ that decide what a chunk holds (bbox, chunk size, pruning...), and is
+ dropped when a run with different ones starts.
+"""
+import os
+import hashlib
+import sqlite3
+
+class DirectoryStore:
+    """
+    Tiles as tile_dir/z/x/y.png, with finished chunk ids listed one per
+    line in tile_dir/completed.log
+    """
+    COMPLETED_LOG = "completed.log"
+
+    def __init__(self, tile_dir):
+        if not tile_dir.endswith('/'):
+            tile_dir = tile_dir + '/'
+        self.tile_dir = tile_dir
+        if not os.path.isdir(tile_dir):
+            os.makedirs(tile_dir)
+        self.columns = set()
+        self.pending = []
+        self.log = None
+
+    def put(self, z, x, y, data):
+        column = self.tile_dir + "%s/%s/" % (z, x)
+        # the directories are made once per column, not per tile
+        if column not in self.columns:
+            if not os.path.isdir(column):
+                os.makedirs(column)
+            self.columns.add(column)
+        fh = open(column + "%s.png" % y, 'wb')
+        fh.write(data)
+        fh.close()
+
+    def empty_tiles(self, z, size, chunks, chunk_size):
+        """
+        Return the (x, y) of tiles at zoom z whose data is size bytes,
+        looking only in the (cx, cy) chunks of chunk_size tiles a side
+        """
+        empty = set()
+        for cx, cy in chunks:
+            for x in range(cx * chunk_size, (cx + 1) * chunk_size):
+                column = self.tile_dir + "%s/%s/" % (z, x)
+                if not os.path.isdir(column):
+                    continue
+                for y in range(cy * chunk_size, (cy + 1) * chunk_size):
+                    try:
+                        if os.path.getsize(column + "%s.png" % y) == size:
+                            empty.add((x, y))
+                    except OSError:
+                        pass
+        return empty
+
+    def completed(self, params=""):
+        """
+        Return the ids of the chunks finished by earlier runs with the same
+        params. A log written with other params is started afresh.
+        """
+        done = set()
+        path = self.tile_dir + self.COMPLETED_LOG
+        header = "# params " + params
+        if os.path.isfile(path):
+            lines = [line.rstrip("\n") for line in open(path)]
+            if lines and lines[0] == header:
+                done.update([line for line in lines[1:] if line])
+                return done
+            print "** render parameters changed, starting a fresh", path
+        fh = open(path, 'w')
+        fh.write(header + "\n")
+        fh.close()
+        return done
+
+    def mark_completed(self, chunk_id):
+        self.pending.append(chunk_id)
+
+    def commit(self):
+        if self.log is None:
+            self.log = open(self.tile_dir + self.COMPLETED_LOG, 'a')
+        for chunk_id in self.pending:
+            self.log.write(chunk_id + "\n")
+        self.log.flush()
+        self.pending = []
+
+    def close(self):
+        self.commit()
+        self.log.close()
+
+class MBTilesStore:
+    """
+    Tiles in an MBTiles file. Image data is stored once per distinct tile,
+    keyed by its hash, so repeated tiles (all the empty ones, open water...)
+    cost one row in the map table each.
+    """
+    def __init__(self, path, name="unknown", bbox=None, minzoom=None, maxzoom=None):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS map (
+                zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+            CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row);
+            CREATE TABLE IF NOT EXISTS images (tile_data BLOB, tile_id TEXT);
+            CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id);
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+            CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name);
+            CREATE TABLE IF NOT EXISTS completed_chunks (chunk_id TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS completed_params (params TEXT);
+            CREATE VIEW IF NOT EXISTS tiles AS
+                SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+                       map.tile_row AS tile_row, images.tile_data AS tile_data
+                FROM map JOIN images ON images.tile_id = map.tile_id;
+            """)
+        metadata = {'name': name, 'type': 'baselayer', 'version': '1.0',
+                    'description': name, 'format': 'png'}
+        if bbox is not None:
+            metadata['bounds'] = ','.join([str(v) for v in bbox])
+        if minzoom is not None:
+            metadata['minzoom'] = str(minzoom)
+        if maxzoom is not None:
+            metadata['maxzoom'] = str(maxzoom)
+        self.conn.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+                              metadata.items())
+        self.conn.commit()
+
+    def put(self, z, x, y, data):
+        tile_id = hashlib.md5(data).hexdigest()
+        self.conn.execute("INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?)",
+                          (sqlite3.Binary(data), tile_id))
+        # MBTiles rows count up from the south, TMS style
+        self.conn.execute("INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id)"
+                          " VALUES (?, ?, ?, ?)", (z, x, 2 ** z - 1 - y, tile_id))
+
+    def empty_tiles(self, z, size, chunks, chunk_size):
+        """
+        Return the (x, y) of tiles at zoom z whose data is size bytes,
+        looking only in the (cx, cy) chunks of chunk_size tiles a side
+        """
+        empty = set()
+        for cx, cy in chunks:
+            # rows count up from the south
+            rows = self.conn.execute("SELECT map.tile_column, map.tile_row FROM map"
+                                     " JOIN images ON images.tile_id = map.tile_id"
+                                     " WHERE map.zoom_level = ?"
+                                     " AND map.tile_column BETWEEN ? AND ?"
+                                     " AND map.tile_row BETWEEN ? AND ?"
+                                     " AND length(images.tile_data) = ?",
+                                     (z, cx * chunk_size, (cx + 1) * chunk_size - 1,
+                                      2 ** z - (cy + 1) * chunk_size, 2 ** z - 1 - cy * chunk_size,
+                                      size))
+            empty.update([(x, 2 ** z - 1 - row) for x, row in rows])
+        return empty
+
+    def completed(self, params=""):
+        """
+        Return the ids of the chunks finished by earlier runs with the same
+        params. Chunks recorded with other params are forgotten.
+        """
+        stored = self.conn.execute("SELECT params FROM completed_params").fetchall()
+        if stored != [(params,)]:
+            if stored:
+                print "** render parameters changed, starting a fresh chunk log"
+            self.conn.execute("DELETE FROM completed_chunks")
+            self.conn.execute("DELETE FROM completed_params")
+            self.conn.execute("INSERT INTO completed_params VALUES (?)", (params,))
+            self.conn.commit()
+        return set([r[0] for r in self.conn.execute("SELECT chunk_id FROM completed_chunks")])
+
+    def mark_completed(self, chunk_id):
+        self.conn.execute("INSERT OR IGNORE INTO completed_chunks VALUES (?)", (chunk_id,))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+def open_store(path, name="unknown", bbox=None, minzoom=None, maxzoom=None):
+    """ An MBTilesStore for paths ending in .mbtiles, otherwise a DirectoryStore """
+    if path.endswith('.mbtiles'):
+        return MBTilesStore(path, name, bbox, minzoom, maxzoom)
+    return DirectoryStore(path)